@@ -0,0 +1,242 @@
+import asyncio
+import contextvars
+import functools
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from state import shared_state
+
+RESPONSE_CACHE_ENABLED = os.environ.get("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 1024))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 3600))
+# Optional SQLite file shared across restarts and workers; empty keeps the cache in memory only
+RESPONSE_CACHE_PATH = os.environ.get("RESPONSE_CACHE_PATH", "")
+# Sampled (temperature > 0) responses are not reproducible, so they bypass the cache by default
+RESPONSE_CACHE_ALL_TEMPERATURES = os.environ.get("RESPONSE_CACHE_ALL_TEMPERATURES", "false").lower() == "true"
+# Expired rows are deleted from the SQLite backend at most this often (seconds)
+RESPONSE_CACHE_PURGE_INTERVAL = float(os.environ.get("RESPONSE_CACHE_PURGE_INTERVAL", 300))
+
+# Set while a call may only be answered from the cache (see cached_only)
+_cache_only = contextvars.ContextVar("cache_only", default=False)
+
+
+class CacheMiss(Exception):
+    pass
+
+
+def request_key(provider, request):
+    """Stable hash of a provider call's arguments."""
+    payload = json.dumps({"provider": provider, "request": request}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class SQLiteCacheBackend:
+    """Shared on-disk cache; expired rows are deleted on read and purged every `purge_interval` seconds."""
+
+    def __init__(self, path, purge_interval=RESPONSE_CACHE_PURGE_INTERVAL):
+        self.path = path
+        self.purge_interval = purge_interval
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)")
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_response_cache_expires_at ON response_cache (expires_at)")
+            self._connection.commit()
+        self.purge()
+
+    def get(self, key):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[1] < time.time():
+                self._connection.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                self._connection.commit()
+                return None
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def set(self, key, value, expires_at):
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), expires_at))
+            self._connection.commit()
+        if time.monotonic() - self._purged_at >= self.purge_interval:
+            self.purge()
+
+    def purge(self):
+        """Delete every expired row; returns the number deleted."""
+        with self._lock:
+            deleted = self._connection.execute(
+                "DELETE FROM response_cache WHERE expires_at < ?", (time.time(),)).rowcount
+            self._connection.commit()
+            self._purged_at = time.monotonic()
+        return deleted
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class ResponseCache:
+    """In-process LRU cache with TTL for provider responses, optionally backed by SQLite or the shared state store.
+
+    The in-process entries are checked first; the shared `state` store (see
+    state.py) lets every worker reuse each other's responses.
+    """
+
+    def __init__(self, max_size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, path=RESPONSE_CACHE_PATH,
+                 cache_all_temperatures=RESPONSE_CACHE_ALL_TEMPERATURES, enabled=RESPONSE_CACHE_ENABLED, state=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cache_all_temperatures = cache_all_temperatures
+        self.enabled = enabled
+        self.backend = SQLiteCacheBackend(path) if path else None
+        self.state = state
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    def should_cache(self, temperature):
+        return self.enabled and (self.cache_all_temperatures or not temperature)
+
+    def record_bypass(self):
+        with self._lock:
+            self.bypassed += 1
+
+    async def get(self, key, count_miss=True):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at >= now:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+        value = None
+        if self.state is not None:
+            value = await self.state.get(f"cache:{key}")
+        elif self.backend is not None:
+            value = await asyncio.to_thread(self.backend.get, key)
+        if value is not None:
+            self._remember(key, value, now + self.ttl)
+            with self._lock:
+                self.hits += 1
+            return value
+
+        if count_miss:
+            with self._lock:
+                self.misses += 1
+        return None
+
+    async def set(self, key, value):
+        expires_at = time.time() + self.ttl
+        self._remember(key, value, expires_at)
+        if self.state is not None:
+            await self.state.set(f"cache:{key}", value, self.ttl)
+        elif self.backend is not None:
+            await asyncio.to_thread(self.backend.set, key, value, expires_at)
+
+    def _remember(self, key, value, expires_at):
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def close(self):
+        if self.backend is not None:
+            self.backend.close()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "size": len(self._entries),
+            }
+
+
+response_cache = ResponseCache(state=shared_state)
+
+
+def cached(provider, cache=None):
+    """Cache an adapter's async process_* method on all of its arguments except on_token.
+
+    Calls with temperature > 0 bypass the cache unless cache_all_temperatures is
+    set. A streaming caller still receives a cached response, as a single chunk.
+    Under cached_only() a call that isn't cached raises CacheMiss instead of
+    reaching the provider.
+    """
+    def decorator(method):
+        signature = inspect.signature(method)
+
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            active_cache = cache or response_cache
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            request = {name: value for name, value in bound.arguments.items() if name not in ("self", "on_token")}
+            on_token = bound.arguments.get("on_token")
+
+            cache_only = _cache_only.get()
+            if not active_cache.should_cache(request.get("temperature")):
+                if cache_only:
+                    raise CacheMiss()
+                active_cache.record_bypass()
+                return await method(self, *args, **kwargs)
+
+            key = request_key(provider, request)
+            # A peek doesn't count as a miss; the real call that follows does
+            result = await active_cache.get(key, count_miss=not cache_only)
+            if result is not None:
+                if on_token is not None and result[0]:
+                    await on_token(result[0])
+                return tuple(result)
+            if cache_only:
+                raise CacheMiss()
+
+            result = await method(self, *args, **kwargs)
+            await active_cache.set(key, list(result))
+            return result
+
+        wrapper.response_cached = True
+        return wrapper
+    return decorator
+
+
+def is_cached(method):
+    """True if `method` (bound or not) is wrapped by cached()."""
+    return getattr(getattr(method, "__func__", method), "response_cached", False) is True
+
+
+async def cached_only(make_call):
+    """Await make_call() but let it answer only from the response cache; returns None on a miss.
+
+    Lets callers check the cache before reserving rate-limit capacity for a provider call.
+    Only use it when the method behind make_call is_cached(); anything else would run for real.
+    """
+    token = _cache_only.set(True)
+    try:
+        return await make_call()
+    except CacheMiss:
+        return None
+    finally:
+        _cache_only.reset(token)
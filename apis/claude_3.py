@@ -1,6 +1,7 @@
 import os
 import json
-import anthropic
+from apis.cache import cached
+from apis.clients import clients
 
 
 class Claude3:
@@ -9,10 +10,11 @@ class Claude3:
         with open("apis/config.json") as f:
             self.config = json.load(f)["CLAUDE_MODELS"]
 
-    def process_claude_model(self, model_name, temperature, system_prompt, refined_input, max_tokens):
-        client = anthropic.Anthropic(api_key=self.api_key)
-
-        response = client.messages.create(
+    @cached("claude")
+    async def process_claude_model(self, model_name, temperature, system_prompt, refined_input, max_tokens,
+                                   on_token=None):
+        client = clients.anthropic_client(self.api_key)
+        request = dict(
             model=self.config[model_name]["name"],
             temperature=temperature,
             max_tokens=max_tokens,
@@ -20,6 +22,14 @@ class Claude3:
             messages=[{"role": "user", "content": refined_input}]
         )
 
+        if on_token is not None:
+            async with client.messages.stream(**request) as stream:
+                async for text in stream.text_stream:
+                    await on_token(text)
+                response = await stream.get_final_message()
+        else:
+            response = await client.messages.create(**request)
+
         content = response.content[0].text
         input_tokens = getattr(response.usage, 'input_tokens', 0)
         output_tokens = getattr(response.usage, 'output_tokens', 0)
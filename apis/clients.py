@@ -0,0 +1,79 @@
+import os
+import httpx
+from openai import AsyncOpenAI
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+MAX_CONNECTIONS = int(os.environ.get("PROVIDER_MAX_CONNECTIONS", 100))
+MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("PROVIDER_MAX_KEEPALIVE_CONNECTIONS", 20))
+KEEPALIVE_EXPIRY = float(os.environ.get("PROVIDER_KEEPALIVE_EXPIRY", 30))
+USE_HTTP2 = os.environ.get("PROVIDER_HTTP2", "true").lower() == "true"
+
+
+class ClientRegistry:
+    """Keeps one SDK client, and so one keep-alive connection pool, per provider endpoint.
+
+    SDK-level retries are off; deadlines and retries are applied by retry.call_with_retries.
+    """
+
+    def __init__(self, max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                 keepalive_expiry=KEEPALIVE_EXPIRY, http2=USE_HTTP2):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry
+        )
+        # HTTP/2 needs the optional h2 package; plain http:// endpoints stay on HTTP/1.1
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self._clients = {}
+
+    def _http_client(self):
+        return httpx.AsyncClient(limits=self.limits, http2=self.http2)
+
+    def openai_client(self, provider, api_key, base_url=None):
+        """Return the shared OpenAI-compatible client for a provider/base_url pair."""
+        key = (provider, base_url)
+        client = self._clients.get(key)
+        if client is None:
+            client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=self._http_client(),
+                                 max_retries=0)
+            self._clients[key] = client
+        return client
+
+    def http_client(self, provider, base_url):
+        """Return the shared plain HTTP client for REST providers without an async SDK (e.g. Monster)."""
+        key = (provider, base_url)
+        client = self._clients.get(key)
+        if client is None:
+            client = httpx.AsyncClient(base_url=base_url, limits=self.limits, http2=self.http2)
+            self._clients[key] = client
+        return client
+
+    def anthropic_client(self, api_key):
+        """Return the shared Anthropic client."""
+        key = ("claude", None)
+        client = self._clients.get(key)
+        if client is None:
+            import anthropic
+            client = anthropic.AsyncAnthropic(api_key=api_key, http_client=self._http_client(), max_retries=0)
+            self._clients[key] = client
+        return client
+
+    async def aclose(self):
+        """Close every pooled client; called from the FastAPI shutdown hook."""
+        clients_to_close = list(self._clients.values())
+        self._clients.clear()
+        for client in clients_to_close:
+            # SDK clients expose close(), plain httpx clients aclose()
+            close = client.aclose if isinstance(client, httpx.AsyncClient) else client.close
+            await close()
+
+    def __len__(self):
+        return len(self._clients)
+
+
+clients = ClientRegistry()
@@ -1,6 +1,8 @@
 import os
 import json
 import google.generativeai as genai
+from apis.cache import cached
+from apis.tokens import count_tokens
 
 class GeminiModel:
     def __init__(self):
@@ -9,9 +11,14 @@ class GeminiModel:
             self.config = json.load(f)["GEMINI_MODELS"]
 
         genai.configure(api_key=self.api_key)
+        self._models = {}
 
-    def process_gemini_model(self, model_name, prompt, temperature, max_tokens):
-        model = genai.GenerativeModel(self.config[model_name]["name"])
+    @cached("gemini")
+    async def process_gemini_model(self, model_name, prompt, temperature, max_tokens):
+        model = self._models.get(model_name)
+        if model is None:
+            model = genai.GenerativeModel(self.config[model_name]["name"])
+            self._models[model_name] = model
 
         generation_config = genai.types.GenerationConfig(
             candidate_count=1,
@@ -19,14 +26,20 @@ class GeminiModel:
             temperature=temperature
         )
 
-        response = model.generate_content(
+        response = await model.generate_content_async(
             prompt,
             generation_config=generation_config
         )
 
         content = response.text
-        # Gemini doesn't provide token usage by default, estimate
-        input_tokens = len(prompt.split()) * 1.3  # rough estimation
-        output_tokens = len(content.split()) * 1.3  # rough estimation
+        # Newer SDKs report usage_metadata; otherwise count with the configured tokenizer
+        usage = getattr(response, "usage_metadata", None)
+        input_tokens = getattr(usage, "prompt_token_count", 0)
+        output_tokens = getattr(usage, "candidates_token_count", 0)
+        tokenizer = self.config[model_name].get("tokenizer")
+        if not input_tokens:
+            input_tokens = count_tokens(tokenizer, prompt)
+        if not output_tokens:
+            output_tokens = count_tokens(tokenizer, content)
         
-        return content, int(input_tokens), int(output_tokens)
\ No newline at end of file
+        return content, input_tokens, output_tokens
\ No newline at end of file
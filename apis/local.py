@@ -1,5 +1,8 @@
 import json
-from openai import OpenAI
+from apis.cache import cached
+from apis.clients import clients
+from apis.streaming import stream_chat_completion
+from apis.tokens import resolve_usage
 
 
 class LocalModel:
@@ -7,22 +10,28 @@ class LocalModel:
         with open("apis/config.json") as f:
             self.config = json.load(f)["LOCAL_MODELS"]
 
-    def process_local_model(self, model_name, messages, temperature, max_tokens):
+    @cached("local")
+    async def process_local_model(self, model_name, messages, temperature, max_tokens, on_token=None):
         base_url = f"http://localhost:{self.config[model_name]['port']}/v1"
-        client = OpenAI(api_key="NONE", base_url=base_url)
-
-        response = client.chat.completions.create(
+        client = clients.openai_client("local", "NONE", base_url)
+        request = dict(
             model=self.config[model_name]["name"],
             messages=messages,
             temperature=temperature,
             max_tokens=max_tokens
         )
-        response_text = response.choices[0].message.content
 
-        input_tokens_estimation = 0
-        for message in messages:
-            input_tokens_estimation += len(message.get("content", ""))
+        if on_token is not None:
+            response_text, prompt_tokens, completion_tokens = await stream_chat_completion(
+                client, on_token, **request)
+        else:
+            response = await client.chat.completions.create(**request)
+            response_text = response.choices[0].message.content
+            prompt_tokens = getattr(response.usage, "prompt_tokens", None)
+            completion_tokens = getattr(response.usage, "completion_tokens", None)
 
-        output_tokens_estimation = len(response_text)
+        # Local servers don't always report usage; count with the model's tokenizer then
+        input_tokens, output_tokens = resolve_usage(
+            self.config[model_name].get("tokenizer"), messages, response_text, prompt_tokens, completion_tokens)
 
-        return response_text, input_tokens_estimation, output_tokens_estimation
+        return response_text, input_tokens, output_tokens
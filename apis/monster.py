@@ -1,25 +1,84 @@
-
+import asyncio
 import json
 import os
+import time
+
+from apis.cache import cached
+from apis.clients import clients
+from apis.tokens import resolve_usage
+from retry import PROVIDER_TIMEOUT
+
+MONSTER_BASE_URL = os.environ.get("MONSTER_BASE_URL", "https://api.monsterapi.ai/v1")
+# Status polling starts fast and backs off geometrically while a job is still running
+MONSTER_POLL_INITIAL = float(os.environ.get("MONSTER_POLL_INITIAL", 0.5))
+MONSTER_POLL_MAX = float(os.environ.get("MONSTER_POLL_MAX", 5.0))
+MONSTER_POLL_BACKOFF = 1.5
+
+MONSTER_DONE = "COMPLETED"
+MONSTER_FAILED = ("FAILED", "CANCELLED", "CANCELED")
+
 
-from monsterapi import client
+class MonsterJobError(Exception):
+    pass
 
 
 class MonsterAPI:
+    """Async Monster API adapter.
+
+    Jobs are submitted and then polled with adaptive intervals over the shared
+    pooled HTTP client, so any number of outstanding jobs can be awaited
+    concurrently without blocking the event loop.
+    """
+
     def __init__(self):
         self.api_key = os.environ.get("MONSTER_API_KEY")
         with open("apis/config.json") as f:
             self.config = json.load(f)["MONSTER_MODELS"]
 
-    def process_monster_model(self, model_name, prompt, parameters):
-        client_instance = client()
+    def _headers(self):
+        return {"Authorization": f"Bearer {self.api_key}", "Accept": "application/json"}
+
+    @cached("monster")
+    async def process_monster_model(self, model_name, messages, temperature, max_tokens, on_token=None):
+        client = clients.http_client("monster", MONSTER_BASE_URL)
+        system_prompt = "\n\n".join(m["content"] for m in messages if m["role"] == "system")
+        prompt = "\n\n".join(m["content"] for m in messages if m["role"] != "system")
+        payload = {"prompt": prompt, "temp": temperature, "max_length": max_tokens}
+        if system_prompt:
+            payload["system_prompt"] = system_prompt
+
+        response = await client.post(f"/generate/{self.config[model_name]['name']}", json=payload,
+                                     headers=self._headers())
+        response.raise_for_status()
+        process_id = response.json()["process_id"]
+
+        timeout = self.config[model_name].get("timeout", PROVIDER_TIMEOUT)
+        result = await self.wait_for_result(client, process_id, timeout)
+        text = result.get("text", "")
+        content = "".join(text) if isinstance(text, list) else str(text)
 
-        response = client_instance.get_response(model=self.config[model_name]["name"], data={
-            "prompt": prompt,
-            **parameters
-        })
+        # Monster doesn't report usage; count with the model's tokenizer (or the estimate)
+        input_tokens, output_tokens = resolve_usage(self.config[model_name].get("tokenizer"), messages, content)
+        if on_token is not None and content:
+            await on_token(content)
+        return content, input_tokens, output_tokens
 
-        process_id = response["process_id"]
-        result = client_instance.wait_and_get_result(process_id)
+    async def wait_for_result(self, client, process_id, timeout):
+        """Poll a job until it completes, sleeping MONSTER_POLL_INITIAL..MONSTER_POLL_MAX between checks."""
+        deadline = time.monotonic() + timeout
+        interval = MONSTER_POLL_INITIAL
+        while True:
+            response = await client.get(f"/status/{process_id}", headers=self._headers())
+            response.raise_for_status()
+            status = response.json()
+            state = str(status.get("status", "")).upper()
+            if state == MONSTER_DONE:
+                return status.get("result") or {}
+            if state in MONSTER_FAILED:
+                raise MonsterJobError(f"Monster job {process_id} {state.lower()}: {status.get('result')}")
 
-        return result
\ No newline at end of file
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError(f"Monster job {process_id} still {state.lower()} after {timeout}s")
+            await asyncio.sleep(min(interval, remaining))
+            interval = min(interval * MONSTER_POLL_BACKOFF, MONSTER_POLL_MAX)
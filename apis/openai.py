@@ -1,6 +1,9 @@
 import os
 import json
-from openai import OpenAI
+from apis.cache import cached
+from apis.clients import clients
+from apis.streaming import stream_chat_completion
+from apis.tokens import resolve_usage
 
 
 class OpenAIModel:
@@ -9,15 +12,23 @@ class OpenAIModel:
         with open("apis/config.json") as f:
             self.config = json.load(f)["OPENAI_MODELS"]
 
-    def process_openai_model(self, model_name, messages, temperature, max_tokens):
-        client = OpenAI(api_key=self.api_key)
-
-        response = client.chat.completions.create(
+    @cached("openai")
+    async def process_openai_model(self, model_name, messages, temperature, max_tokens, on_token=None):
+        client = clients.openai_client("openai", self.api_key)
+        request = dict(
             model=self.config[model_name]["name"],
             messages=messages,
             temperature=temperature,
             max_tokens=max_tokens
         )
+
+        if on_token is not None:
+            content, prompt_tokens, completion_tokens = await stream_chat_completion(client, on_token, **request)
+            prompt_tokens, completion_tokens = resolve_usage(
+                self.config[model_name].get("tokenizer"), messages, content, prompt_tokens, completion_tokens)
+            return content, prompt_tokens, completion_tokens
+
+        response = await client.chat.completions.create(**request)
         content = response.choices[0].message.content
         prompt_tokens = response.usage.prompt_tokens
         completion_tokens = response.usage.completion_tokens
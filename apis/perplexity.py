@@ -1,6 +1,9 @@
 import os
 import json
-from openai import OpenAI
+from apis.cache import cached
+from apis.clients import clients
+from apis.streaming import stream_chat_completion
+from apis.tokens import resolve_usage
 
 
 class PerplexityModel:
@@ -9,15 +12,23 @@ class PerplexityModel:
         with open("apis/config.json") as f:
             self.config = json.load(f)["PERPLEXITY_MODELS"]
 
-    def process_perplexity_model(self, model_name, messages, temperature, max_tokens):
-        client = OpenAI(api_key=self.api_key, base_url="https://api.perplexity.ai")
-
-        response = client.chat.completions.create(
+    @cached("perplexity")
+    async def process_perplexity_model(self, model_name, messages, temperature, max_tokens, on_token=None):
+        client = clients.openai_client("perplexity", self.api_key, "https://api.perplexity.ai")
+        request = dict(
             model=self.config[model_name]["name"],
             messages=messages,
             temperature=temperature,
             max_tokens=max_tokens
         )
+
+        if on_token is not None:
+            content, input_tokens, output_tokens = await stream_chat_completion(client, on_token, **request)
+            input_tokens, output_tokens = resolve_usage(
+                self.config[model_name].get("tokenizer"), messages, content, input_tokens, output_tokens)
+            return content, input_tokens, output_tokens
+
+        response = await client.chat.completions.create(**request)
         
         content = response.choices[0].message.content
         input_tokens = getattr(response.usage, 'prompt_tokens', 0)
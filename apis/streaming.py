@@ -0,0 +1,34 @@
+def _usage_field(usage, key):
+    # Older SDKs keep the final usage chunk as a plain dict in the model's extra fields
+    if isinstance(usage, dict):
+        return usage.get(key)
+    return getattr(usage, key, None)
+
+
+async def stream_chat_completion(client, on_token, **request):
+    """Run an OpenAI-compatible chat completion with stream=True.
+
+    Each content delta is awaited through on_token as it arrives. Returns
+    (content, prompt_tokens, completion_tokens); the token counts are None when
+    the server did not report usage for the stream.
+    """
+    stream = await client.chat.completions.create(
+        stream=True,
+        # Servers that support it append a final chunk carrying token usage
+        extra_body={"stream_options": {"include_usage": True}},
+        **request
+    )
+
+    parts = []
+    usage = None
+    async for chunk in stream:
+        if getattr(chunk, "usage", None):
+            usage = chunk.usage
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            parts.append(delta)
+            await on_token(delta)
+
+    return "".join(parts), _usage_field(usage, "prompt_tokens"), _usage_field(usage, "completion_tokens")
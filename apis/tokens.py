@@ -0,0 +1,104 @@
+import functools
+import json
+import os
+
+# Tokenizers are only fetched from the Hugging Face Hub when explicitly allowed;
+# otherwise they must already be in the local cache (or be a local tokenizer.json).
+# The Docker image fills the cache at build time with `python -m apis.tokens`.
+TOKENIZER_DOWNLOAD = os.environ.get("TOKENIZER_DOWNLOAD", "false").lower() == "true"
+
+# Per-message framing overhead of chat templates (role markers, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def heuristic_count(text):
+    """Fallback estimate of ~4 characters per token."""
+    return len(text) // 4
+
+
+def _load_tiktoken(name):
+    import tiktoken
+    encoding = tiktoken.get_encoding(name)
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def _load_huggingface(name):
+    from tokenizers import Tokenizer
+    if name.endswith(".json"):
+        tokenizer = Tokenizer.from_file(name)
+    else:
+        from huggingface_hub import hf_hub_download
+        path = hf_hub_download(name, "tokenizer.json", local_files_only=not TOKENIZER_DOWNLOAD)
+        tokenizer = Tokenizer.from_file(path)
+    return lambda text: len(tokenizer.encode(text, add_special_tokens=False).ids)
+
+
+TOKENIZER_LOADERS = {
+    "tiktoken": _load_tiktoken,
+    "hf": _load_huggingface,
+}
+
+
+def register_tokenizer(family, loader):
+    """Register a loader for a tokenizer family; loader(name) returns a text -> token count callable."""
+    TOKENIZER_LOADERS[family] = loader
+    get_counter.cache_clear()
+
+
+@functools.lru_cache(maxsize=None)
+def get_counter(spec):
+    """Return a token counting function for a "family:name" spec from apis/config.json.
+
+    Tokenizers are loaded once per spec. Unknown or unavailable tokenizers fall
+    back to heuristic_count.
+    """
+    if spec and ":" in spec:
+        family, name = spec.split(":", 1)
+        loader = TOKENIZER_LOADERS.get(family)
+        if loader is not None:
+            try:
+                return functools.lru_cache(maxsize=1024)(loader(name))
+            except Exception as e:
+                print(f"Tokenizer {spec} unavailable ({e}); falling back to a character estimate.")
+    return heuristic_count
+
+
+def count_tokens(spec, text):
+    return get_counter(spec)(text or "")
+
+
+def count_message_tokens(spec, messages):
+    counter = get_counter(spec)
+    return sum(counter(message.get("content", "") or "") + MESSAGE_OVERHEAD_TOKENS for message in messages)
+
+
+def resolve_usage(spec, messages, content, prompt_tokens=None, completion_tokens=None):
+    """Prefer server-reported usage and count with the tokenizer only for what is missing."""
+    if not prompt_tokens:
+        prompt_tokens = count_message_tokens(spec, messages)
+    if not completion_tokens:
+        completion_tokens = count_tokens(spec, content)
+    return prompt_tokens, completion_tokens
+
+
+def prefetch_tokenizers(config_path="apis/config.json"):
+    """Load every tokenizer named in apis/config.json so it is cached locally; returns the specs that failed."""
+    with open(config_path) as f:
+        config = json.load(f)
+    specs = {entry["tokenizer"] for section in config.values() for entry in section.values()
+             if isinstance(entry, dict) and entry.get("tokenizer")}
+    failed = []
+    for spec in sorted(specs):
+        family, _, name = spec.partition(":")
+        try:
+            TOKENIZER_LOADERS[family](name)
+            print(f"Cached tokenizer {spec}")
+        except Exception as e:
+            print(f"Could not fetch tokenizer {spec}: {e}")
+            failed.append(spec)
+    return failed
+
+
+if __name__ == "__main__":
+    # Run with TOKENIZER_DOWNLOAD=true (and HF_TOKEN for gated repos) to fill the local cache
+    prefetch_tokenizers()
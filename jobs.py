@@ -0,0 +1,174 @@
+# jobs.py
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 4))
+JOB_QUEUE_SIZE = int(os.environ.get("JOB_QUEUE_SIZE", 100))
+JOB_RESULT_RETENTION = int(os.environ.get("JOB_RESULT_RETENTION", 1000))
+# How long job status stays readable from other workers through the shared state store (seconds)
+JOB_STATUS_TTL = float(os.environ.get("JOB_STATUS_TTL", 3600))
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class JobQueue:
+    """Bounded queue of /process, /process/stream and /process/batch jobs drained by a fixed pool of worker coroutines.
+
+    The handler is awaited as handler(task_id, user_input, job, **options) and may
+    update job["iteration"], job["input_tokens"] and job["output_tokens"] as it runs.
+    An optional on_finish(job) coroutine is awaited once the job has completed or failed.
+    With a shared `state` store (see state.py) each status change is also written
+    there, so lookup() finds jobs started by any worker.
+    """
+
+    def __init__(self, handler, workers=JOB_WORKERS, max_queue_size=JOB_QUEUE_SIZE,
+                 retention=JOB_RESULT_RETENTION, state=None, status_ttl=JOB_STATUS_TTL):
+        self.handler = handler
+        self.state = state
+        self.status_ttl = status_ttl
+        self.workers = workers
+        self.max_queue_size = max_queue_size
+        self.retention = retention
+        self.jobs = OrderedDict()
+        self._running = {}
+        self._queue = None
+        self._worker_tasks = []
+        self._loop = None
+
+    def start(self):
+        """Start the worker pool on the running event loop (no-op if already running there)."""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._worker_tasks:
+            return
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for worker in self._worker_tasks:
+            worker.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+        self._loop = None
+
+    def submit(self, task_id, user_input, on_finish=None, **options):
+        """Enqueue a job and return its status record; raises QueueFullError when saturated."""
+        self.start()
+        job = self._new_job(task_id)
+        try:
+            self._queue.put_nowait((job, user_input, options, on_finish))
+        except asyncio.QueueFull:
+            raise QueueFullError(f"Job queue is full ({self.max_queue_size} pending tasks)")
+        self._track(job)
+        return job
+
+    async def enqueue(self, task_id, user_input, on_finish=None, **options):
+        """Like submit(), but wait for room in the queue instead of raising QueueFullError."""
+        self.start()
+        job = self._new_job(task_id)
+        await self._queue.put((job, user_input, options, on_finish))
+        self._track(job)
+        return job
+
+    def _new_job(self, task_id):
+        return {
+            "task_id": task_id,
+            "status": QUEUED,
+            "iteration": 0,
+            "input_tokens": 0,
+            "output_tokens": 0,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "result": None,
+            "error": None,
+        }
+
+    def _track(self, job):
+        self.jobs[job["task_id"]] = job
+        self._evict_finished()
+        self._publish(job)
+
+    def _publish(self, job):
+        if self.state is not None:
+            self.state.run_soon(self.state.set(f"job:{job['task_id']}", dict(job), self.status_ttl))
+
+    def get(self, task_id):
+        return self.jobs.get(task_id)
+
+    async def lookup(self, task_id):
+        """Like get(), but also finds jobs run by other workers through the shared state store."""
+        job = self.jobs.get(task_id)
+        if job is None and self.state is not None:
+            job = await self.state.get(f"job:{task_id}")
+        return job
+
+    def cancel(self, task_id):
+        """Cancel a queued or running job; finished jobs are left alone."""
+        job = self.jobs.get(task_id)
+        if job is None:
+            return
+        if job["status"] == QUEUED:
+            job["status"] = FAILED
+            job["error"] = "cancelled"
+            job["finished_at"] = time.time()
+            self._publish(job)
+        elif task_id in self._running:
+            self._running[task_id].cancel()
+
+    def queue_depth(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _worker(self):
+        while True:
+            job, user_input, options, on_finish = await self._queue.get()
+            try:
+                # Jobs cancelled while they were queued are skipped
+                if job["status"] == QUEUED:
+                    await self._run(job, user_input, options)
+                    if on_finish is not None:
+                        await on_finish(job)
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job, user_input, options):
+        job["status"] = RUNNING
+        job["started_at"] = time.time()
+        self._publish(job)
+        # Each job runs in its own task so cancel() can stop it without stopping the worker
+        handler_task = asyncio.ensure_future(self.handler(job["task_id"], user_input, job, **options))
+        self._running[job["task_id"]] = handler_task
+        try:
+            job["result"] = await handler_task
+            job["status"] = COMPLETED
+        except asyncio.CancelledError:
+            job["status"] = FAILED
+            job["error"] = "cancelled"
+            if asyncio.current_task().cancelling():
+                raise
+        except Exception as e:
+            print(f"Error processing task {job['task_id']}: {str(e)}")
+            job["status"] = FAILED
+            job["error"] = str(e)
+        finally:
+            job["finished_at"] = time.time()
+            del self._running[job["task_id"]]
+            self._publish(job)
+
+    def _evict_finished(self):
+        # Only finished jobs are dropped; queued and running ones are always kept
+        excess = len(self.jobs) - self.retention
+        if excess <= 0:
+            return
+        for task_id in [tid for tid, job in self.jobs.items() if job["status"] in (COMPLETED, FAILED)][:excess]:
+            del self.jobs[task_id]
@@ -1,22 +1,52 @@
 # main.py
 
-from fastapi import FastAPI
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, Query, Request
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 import os
+import json
 import time
-import glob
-import random
-import xml.etree.ElementTree as ET
+import asyncio
 import uuid
-from apis.openai import OpenAIModel
+from typing import Optional
+from contextlib import asynccontextmanager
+from apis.cache import response_cache, cached_only
+from apis.clients import clients
 from apis.local import LocalModel
+from jobs import JobQueue, QueueFullError, COMPLETED, FAILED
+from tag_parser import StreamingTagParser, parse_tags
+from rate_limit import RateLimiter, model_entry
+from apis.tokens import count_message_tokens, get_counter
+from memory import MemoryStore
+from prompt_builder import PromptBuilder, prompt_budget
+from retry import call_with_retries
+from router import Router, ChatAdapter, create_adapter, parse_models, ROUTER_MODELS
+from state import shared_state, STATE_BACKEND
+from stop import TaskProgress, Deadline, default_stop_conditions, stop_reason, time_remaining, \
+    MAX_ITERATIONS_REACHED
+from task_store import TaskStore, TaskWriter
 
 # Global variable for provider selection
-SELECTED_PROVIDER = os.environ.get("AI_PROVIDER", "local").lower()  # Defaults to "local"
-
-app = FastAPI()
+SELECTED_PROVIDER = os.environ.get("AI_PROVIDER", "local").lower()  # Preferred provider, "auto" for none
+
+
+@asynccontextmanager
+async def lifespan(app):
+    job_queue.start()
+    task_writer.start()
+    yield
+    await job_queue.stop()
+    # Drain queued task records before closing the store
+    await task_writer.stop()
+    # Release pooled provider connections on shutdown
+    await clients.aclose()
+    response_cache.close()
+    task_store.close()
+    if shared_state is not None:
+        await shared_state.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 origins = [
     "*",
@@ -43,6 +73,8 @@ During the conversation, you can use the following tags to structure your respon
 
 <wizard_task>: Use this tag to send tasks or queries to another AI assistant named WizardCoder-17b. The content within these tags will be sent to WizardCoder-17b for processing, and the response will be sent back to you.
 
+<final_answer>: Add an empty <final_answer></final_answer> once your <Response_to_User> is complete and needs no further refinement. The conversation ends there.
+
 Please structure your responses using these tags to ensure proper communication and display of information to the user.
 """
 
@@ -62,207 +94,254 @@ When providing your response, please use the following tags:
 Please make sure to structure your response using these tags and provide the requested information accurately and concisely.
 """
 MAX_ITERATIONS = 4000
+MIXTRAL_MAX_TOKENS = 100
+# Sections forwarded to streaming clients as they are generated
+STREAMED_TAGS = ("Response_to_User", "questions_for_user")
 MAX_REQUESTS_PER_MINUTE = 15
 MAX_TOKENS_PER_MINUTE = 450000
 DELAY_AFTER_REQUESTS = 5
 DELAY_DURATION = 5
+WIZARD_CONCURRENCY = int(os.environ.get("WIZARD_CONCURRENCY", 4))
+WIZARD_TIMEOUT = float(os.environ.get("WIZARD_TIMEOUT", 120))
+# Items of one /process/batch request that may be queued or running at once
+BATCH_CONCURRENCY = int(os.environ.get("BATCH_CONCURRENCY", 4))
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 10000))
+# "provider/model" that wizard tasks are sent to, e.g. monster/mpt-7b-instruct
+WIZARD_MODEL = os.environ.get("WIZARD_MODEL", "local/WizardCoder-17b")
 
-long_memory = []
-short_memory = []
-
-request_count = 0
-token_count = 0
-last_request_time = time.time()
-last_token_time = time.time()
+memory_store = MemoryStore(state=shared_state)
 
-class TaskFile:
-    def __init__(self, task_id):
-        self.task_id = task_id
-        self.root = ET.Element("task")
-        self.root.set("id", str(task_id))
+with open("apis/config.json") as f:
+    MODEL_CONFIG = json.load(f)
 
-    def add_element(self, tag, text):
-        element = ET.SubElement(self.root, tag)
-        element.text = text
-
-    def save(self):
-        tree = ET.ElementTree(self.root)
-        filename = f"task_{self.task_id}.xml"
-        tree.write(filename)
+rate_limiter = RateLimiter(MODEL_CONFIG, MAX_REQUESTS_PER_MINUTE, MAX_TOKENS_PER_MINUTE, state=shared_state)
+task_store = TaskStore()
+task_writer = TaskWriter(task_store)
 
 class Mixtral:
     def __init__(self):
         self.local_model = LocalModel() # Keep for local wizard if nothing else
-        self.openai_model = None
-        
-        # Initialize the selected provider with proper error handling
-        try:
-            if SELECTED_PROVIDER == "openai":
-                api_key = os.environ.get("OPENAI_API_KEY")
-                if not api_key:
-                    print("Warning: OPENAI_API_KEY not set. Falling back to local provider for Mixtral.")
-                    print("Using local provider for Mixtral.")
-                else:
-                    self.openai_model = OpenAIModel()
-                    print("Using OpenAI provider.")
-            else:
-                print("Using local provider for Mixtral.")
-        except Exception as e:
-            print(f"Error initializing provider {SELECTED_PROVIDER}: {e}")
-            print("Falling back to local provider.")
-            
-        self.wizard_queue = []
-
-    def process_task(self, task_id, user_input):
-        task_file = TaskFile(task_id)
-        task_file.add_element("user_input", user_input)
-
-        mixtral_response = self.phase_one(user_input, task_id)
 
-        task_file.add_element("mixtral_response", mixtral_response)
-        task_file.save()
+        # Every configured provider sits behind the router; the selected one is preferred while healthy
+        models = parse_models(ROUTER_MODELS)
+        adapters = {"local": ChatAdapter(self.local_model, "process_local_model")}
+        for provider in {provider for provider, _ in models} - set(adapters):
+            adapter = create_adapter(provider)
+            if adapter is not None:
+                adapters[provider] = adapter
+        if SELECTED_PROVIDER not in ("auto", "local") and SELECTED_PROVIDER not in adapters:
+            print(f"Warning: provider {SELECTED_PROVIDER} is not available. Falling back to the router's choice.")
+        self.router = Router(MODEL_CONFIG, rate_limiter, adapters, models,
+                             None if SELECTED_PROVIDER == "auto" else SELECTED_PROVIDER)
+        print(f"Routing Mixtral across: {', '.join(f'{p}/{m}' for p, m in self.router.models)}")
+
+        provider, model_key = self.router.primary()
+        self.prompt_builder = PromptBuilder(SYSTEM_PROMPT_MIXTRAL,
+                                            get_counter(self.tokenizer_for(provider, model_key)))
+        self.stop_conditions = default_stop_conditions()
+        self.wizard_concurrency = WIZARD_CONCURRENCY
+        self.wizard_timeout = WIZARD_TIMEOUT
+        self.wizard_provider, self.wizard_model = (parse_models(WIZARD_MODEL) or [("local", "WizardCoder-17b")])[0]
+        self.wizard_adapter = adapters.get(self.wizard_provider) or create_adapter(self.wizard_provider)
+        if self.wizard_adapter is None or not model_entry(MODEL_CONFIG, self.wizard_provider, self.wizard_model):
+            print(f"Warning: wizard model {WIZARD_MODEL} is not available. Using local/WizardCoder-17b.")
+            self.wizard_provider, self.wizard_model = "local", "WizardCoder-17b"
+            self.wizard_adapter = adapters["local"]
+
+    async def process_task(self, task_id, user_input, progress=None, on_event=None, session_id=None):
+        mixtral_response = await self.phase_one(user_input, task_id, progress, on_event, session_id)
+
+        # Persisted by the background writer, off the response path
+        await task_writer.add_task(task_id, user_input, mixtral_response, mixtral_response["stop_reason"])
 
         return mixtral_response
 
-    def phase_one(self, user_input, task_id):
-        global request_count, token_count
-
-        system_prompt = SYSTEM_PROMPT_MIXTRAL
+    async def phase_one(self, user_input, task_id, progress=None, on_event=None, session_id=None):
+        # Memory is isolated per session; without a session each task gets its own
+        memory_key = session_id or task_id
+        memory = await memory_store.load(memory_key)
+        system_prompt, prompt_report = self.prompt_builder.build([])
         refined_input = user_input
+        refined_sections = parse_tags(user_input)
         total_input_tokens = 0
         total_output_tokens = 0
+        task_progress = TaskProgress()
+        stop = None
 
         for i in range(MAX_ITERATIONS):
             print(f"Iteration {i + 1} - Sending request to the model...")
-
-            self.wait_for_rate_limit()
+            if on_event is not None:
+                await on_event({"event": "iteration_start", "iteration": i + 1})
 
             messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": refined_input}]
 
-            mixtral_response_content = ""
-            input_tokens = 0
-            output_tokens = 0
-
-            if SELECTED_PROVIDER == "openai" and self.openai_model:
-                # Assuming you have a default OpenAI model name, e.g., "gpt-3.5-turbo-0125"
-                # This model name should ideally come from config.json or be a parameter
-                openai_model_name_key = "gpt-3.5-turbo-0125" # This is a key in apis/config.json for OpenAI
-                mixtral_response_content, input_tokens, output_tokens = self.openai_model.process_openai_model(
-                    openai_model_name_key, messages, 0.5, 100 # Max tokens might need adjustment
-                )
-            else: # Default or fallback to local
-                mixtral_response_content, input_tokens, output_tokens = self.local_model.process_local_model(
-                    "mixtral-8x7b-local", messages, 0.5, 100
-                )
-
-            request_count += 1
-            token_count += input_tokens + output_tokens
+            # One parser per iteration; when streaming it sees the tokens as they arrive
+            parser = StreamingTagParser()
+            on_token = self.token_forwarder(on_event, i + 1, parser)
+
+            call_start = time.monotonic()
+            # A wall-clock deadline also cuts off the iteration in flight
+            deadline = asyncio.timeout(time_remaining(self.stop_conditions, task_progress))
+            try:
+                async with deadline:
+                    mixtral_response_content, input_tokens, output_tokens, (provider, model_key) = \
+                        await self.router.complete(messages, 0.5, MIXTRAL_MAX_TOKENS, on_token=on_token)
+            except TimeoutError:
+                if not deadline.expired():
+                    raise
+                stop = Deadline.reason
+                print(f"Iteration {i + 1} - Deadline reached, discarding this iteration")
+                break
+            latency = time.monotonic() - call_start
+            await task_writer.add_iteration(task_id, i + 1, provider, model_key, prompt_report["total"],
+                                            input_tokens, output_tokens, latency)
             total_input_tokens += input_tokens
             total_output_tokens += output_tokens
+            if progress is not None:
+                progress["iteration"] = i + 1
+                progress["input_tokens"] = total_input_tokens
+                progress["output_tokens"] = total_output_tokens
+            if on_event is not None:
+                await on_event({"event": "iteration_end", "iteration": i + 1,
+                                "input_tokens": input_tokens, "output_tokens": output_tokens,
+                                "prompt_sections": prompt_report})
 
             print(f"Iteration {i + 1} - Model output received:")
             print(mixtral_response_content)
             print()
 
-            questions_from_user = self.extract_questions_for_user(mixtral_response_content)
+            if on_token is None:
+                parser.feed(mixtral_response_content)
+            sections = parser.finish()
+
+            questions_from_user = [q.strip() for section in sections["questions_for_user"]
+                                   for q in section.split("\n") if q.strip()]
             if questions_from_user and (i == MAX_ITERATIONS // 2 - 1 or i == MAX_ITERATIONS - 1):
-                self.pause_for_questions(questions_from_user)
+                # pause_for_questions reads stdin, keep it off the event loop
+                await asyncio.to_thread(self.pause_for_questions, questions_from_user)
 
-            if "<internal_monologue>" in mixtral_response_content:
-                internal_monologue = self.extract_internal_monologue(mixtral_response_content)
-            else:
-                internal_monologue = ""
+            internal_monologue = "\n".join(sections["internal_monologue"])
 
             print(f"Iteration {i + 1} - Internal monologue:")
             print(internal_monologue)
             print()
 
-            long_memory.append(internal_monologue)
-            if len(short_memory) < 5:
-                short_memory.append(internal_monologue)
-            else:
-                short_memory.pop(0)
-                short_memory.append(internal_monologue)
+            memory.add(internal_monologue)
+            await memory_store.save(memory_key, memory)
 
-            system_prompt = self.analyze_and_refine_prompt(internal_monologue, system_prompt)
             refined_input = mixtral_response_content
+            refined_sections = sections
+
+            task_progress.record(mixtral_response_content, sections, input_tokens, output_tokens,
+                                 self.router.estimated_price(provider, model_key, input_tokens, output_tokens))
+            stop = stop_reason(self.stop_conditions, task_progress)
+            if stop is not None:
+                print(f"Iteration {i + 1} - Stopping early: {stop}")
+                break
+
+            budget = prompt_budget(MODEL_CONFIG, provider, model_key, MIXTRAL_MAX_TOKENS,
+                                   self.prompt_builder.count_tokens(refined_input))
+            system_prompt, prompt_report = self.analyze_and_refine_prompt(internal_monologue, memory, budget)
 
             if (i + 1) % DELAY_AFTER_REQUESTS == 0:
                 print(f"Pausing for {DELAY_DURATION} seconds after {DELAY_AFTER_REQUESTS} requests...")
-                time.sleep(DELAY_DURATION)
-
-        # Process wizard tasks from the queue
-        while self.wizard_queue:
-            wizard_task = self.wizard_queue.pop(0)
-            wizard_messages = [{"role": "system", "content": SYSTEM_PROMPT_WIZARD}, 
-                              {"role": "user", "content": wizard_task}]
-            wizard_response_content, wizard_input_tokens, wizard_output_tokens = self.local_model.process_local_model(
-                "WizardCoder-17b", wizard_messages, 0.5, 100)
-            token_count += wizard_input_tokens + wizard_output_tokens  # Update token count
-            refined_input += f"\nWizard response: {wizard_response_content}"
-
-        return self.format_response(refined_input)
-    def format_response(self, response):
-        response_to_user = self.extract_tag(response, "Response_to_User")
-        questions_for_user = self.extract_tag(response, "questions_for_user")
-        tasks = self.extract_tag(response, "tasks")
-        wizard_tasks = self.extract_tag(response, "wizard_task")
-
-        self.wizard_queue.extend(wizard_tasks)
+                await asyncio.sleep(DELAY_DURATION)
+
+        # Wizard tasks belong to this task only and are dispatched concurrently
+        wizard_results = await self.dispatch_wizard_tasks(refined_sections["wizard_task"], on_event)
+
+        # Merge in task order, regardless of completion order
+        for wizard_response_content, error in wizard_results:
+            if error is None:
+                refined_input += f"\nWizard response: {wizard_response_content}"
+            else:
+                refined_input += f"\nWizard task failed: {error}"
+
+        stop = stop or MAX_ITERATIONS_REACHED
+        if on_event is not None:
+            await on_event({"event": "stop", "reason": stop, "iterations": task_progress.iteration})
+
+        response = self.format_response(refined_input, refined_sections)
+        response["stop_reason"] = stop
+        response["iterations"] = task_progress.iteration
+        return response
+
+    async def dispatch_wizard_tasks(self, wizard_tasks, on_event=None):
+        """Send wizard tasks to the wizard model (WIZARD_MODEL) concurrently.
+
+        At most wizard_concurrency calls are in flight. Each attempt has the model's
+        deadline and retryable errors are retried, all within wizard_timeout.
+        Returns one (content, error) pair per task, in input order.
+        """
+        semaphore = asyncio.Semaphore(self.wizard_concurrency)
+        provider, model = self.wizard_provider, self.wizard_model
+        adapter = self.wizard_adapter
+
+        async def run_wizard_task(index, wizard_task):
+            wizard_messages = [{"role": "system", "content": SYSTEM_PROMPT_WIZARD},
+                               {"role": "user", "content": wizard_task}]
+
+            def call_wizard():
+                return adapter.complete(model, wizard_messages, 0.5, 100)
+
+            async with semaphore:
+                # A cached answer needs no rate-limit capacity
+                cached_result = await cached_only(call_wizard) if adapter.cacheable() else None
+                if cached_result is not None:
+                    wizard_response_content = cached_result[0]
+                else:
+                    reservation = await rate_limiter.acquire(
+                        provider, model,
+                        count_message_tokens(self.tokenizer_for(provider, model), wizard_messages) + 100)
+                    used_tokens = 0
+                    try:
+                        async with asyncio.timeout(self.wizard_timeout):
+                            wizard_response_content, wizard_input_tokens, wizard_output_tokens = \
+                                await call_with_retries(call_wizard, self.router.timeout_for(provider, model))
+                        used_tokens = wizard_input_tokens + wizard_output_tokens
+                    except TimeoutError:
+                        print(f"Wizard task {index + 1} timed out after {self.wizard_timeout} seconds")
+                        return None, "timed out"
+                    except Exception as e:
+                        print(f"Wizard task {index + 1} failed: {e}")
+                        return None, str(e)
+                    finally:
+                        # Failed and timed-out calls give their reserved tokens back too
+                        rate_limiter.reconcile(reservation, used_tokens)
+
+            if on_event is not None:
+                await on_event({"event": "wizard_response", "index": index, "text": wizard_response_content})
+            return wizard_response_content, None
+
+        return await asyncio.gather(*(run_wizard_task(index, task) for index, task in enumerate(wizard_tasks)))
+
+    def token_forwarder(self, on_event, iteration, parser):
+        """Build an on_token callback that feeds parser and forwards tokens and STREAMED_TAGS sections to on_event."""
+        if on_event is None:
+            return None
+
+        async def on_token(text):
+            await on_event({"event": "token", "iteration": iteration, "text": text})
+            for kind, tag, section_text in parser.feed(text):
+                if tag in STREAMED_TAGS:
+                    await on_event({"event": f"section_{kind}", "iteration": iteration,
+                                    "tag": tag, "text": section_text})
+
+        return on_token
+
+    def format_response(self, response, sections=None):
+        """Build the API response; tags that occur more than once are joined with newlines."""
+        if sections is None:
+            sections = parse_tags(response)
 
         formatted_response = {
-            "response_to_user": response_to_user,
-            "questions_for_user": questions_for_user,
-            "tasks": tasks
+            "response_to_user": "\n".join(sections["Response_to_User"]),
+            "questions_for_user": "\n".join(sections["questions_for_user"]),
+            "tasks": "\n".join(sections["tasks"])
         }
 
         return formatted_response
 
-    def extract_tag(self, content, tag):
-        start_tag = f"<{tag}>"
-        end_tag = f"</{tag}>"
-        start_index = content.find(start_tag)
-        end_index = content.find(end_tag)
-
-        if start_index != -1 and end_index != -1:
-            start_index += len(start_tag)
-            return content[start_index:end_index].strip()
-        else:
-            return ""
-    def wait_for_rate_limit(self):
-        global last_request_time, last_token_time, request_count, token_count
-
-        current_time = time.time()
-
-        if request_count >= MAX_REQUESTS_PER_MINUTE:
-            elapsed_time = current_time - last_request_time
-            if elapsed_time < 60:
-                wait_time = 60 - elapsed_time
-                print(f"Request rate limit exceeded. Waiting for {wait_time:.2f} seconds...")
-                time.sleep(wait_time)
-                last_request_time = time.time()
-                request_count = 0
-
-        if token_count >= MAX_TOKENS_PER_MINUTE:
-            elapsed_time = current_time - last_token_time
-            if elapsed_time < 60:
-                wait_time = 60 - elapsed_time
-                print(f"Token rate limit exceeded. Waiting for {wait_time:.2f} seconds...")
-                time.sleep(wait_time)
-                last_token_time = time.time()
-                token_count = 0
-
-    def extract_questions_for_user(self, content):
-        start_tag = "<questions_for_user>"
-        end_tag = "</questions_for_user>"
-        start_index = content.find(start_tag) + len(start_tag)
-        end_index = content.find(end_tag)
-        if start_index != -1 and end_index != -1:
-            questions_text = content[start_index:end_index].strip()
-            questions = [q.strip() for q in questions_text.split("\n") if q.strip()]
-            return questions
-        return []
-
     def pause_for_questions(self, questions_from_user):
         if questions_from_user:
             print("Questions for the user:")
@@ -284,37 +363,35 @@ class Mixtral:
         else:
             print("No questions to display.")
 
-    def analyze_and_refine_prompt(self, internal_monologue, system_prompt):
-        print("Analyzing and refining prompt...")
-        refined_prompt = system_prompt + " " + internal_monologue
+    def tokenizer_for(self, provider, model_key):
+        return model_entry(MODEL_CONFIG, provider, model_key).get("tokenizer")
 
-        if long_memory:
-            sample_size = random.randint(1, len(long_memory))
-            long_memory_sample = random.sample(long_memory, sample_size)
-            refined_prompt += " ".join(long_memory_sample)
+    def analyze_and_refine_prompt(self, internal_monologue, memory, budget=None):
+        """Rebuild the system prompt from the base prompt, the latest monologue and sampled memory.
 
-        if short_memory:
-            sample_size = random.randint(1, len(short_memory))
-            short_memory_sample = random.sample(short_memory, sample_size)
-            refined_prompt += " ".join(short_memory_sample)
+        The prompt is rebuilt every iteration rather than appended to, so it stays
+        within the model's token budget. Returns (prompt, per-section token report).
+        """
+        print("Analyzing and refining prompt...")
+        long_memory_sample, short_memory_sample = memory.sample()
+        refined_prompt, report = self.prompt_builder.build([
+            ("monologue", [internal_monologue]),
+            ("short_memory", short_memory_sample),
+            ("long_memory", long_memory_sample),
+        ], budget)
 
         print("Refined prompt:", refined_prompt)
+        print("Prompt tokens by section:", report)
         print()
-        return refined_prompt
-
-    def extract_internal_monologue(self, content):
-        start_tag = "<internal_monologue>"
-        end_tag = "</internal_monologue>"
-        start_index = content.find(start_tag) + len(start_tag)
-        end_index = content.find(end_tag)
-        internal_monologue = content[start_index:end_index].strip()
-        return internal_monologue
+        return refined_prompt, report
 
 mixtral = Mixtral()
+job_queue = JobQueue(mixtral.process_task, state=shared_state)
 
 class InputData(BaseModel):
     user_input: str
     task_id: int
+    session_id: Optional[str] = None
 
 @app.get("/")
 @app.get("/index.html")
@@ -334,32 +411,202 @@ async def health_check():
     return {
         "status": "healthy",
         "provider": SELECTED_PROVIDER,
+        "state_backend": STATE_BACKEND if shared_state is not None else "local",
+        "router": mixtral.router.stats(),
+        "rate_limits": rate_limiter.stats(),
+        "response_cache": response_cache.stats(),
+        "task_writer": task_writer.stats(),
         "timestamp": time.time()
     }
 
 @app.post("/process")
 async def process_input(input_data: InputData):
+    server_task_id = str(uuid.uuid4())
     try:
-        server_task_id = str(uuid.uuid4())
-        mixtral_ai_response = mixtral.process_task(server_task_id, input_data.user_input)
+        job_queue.submit(server_task_id, input_data.user_input, session_id=input_data.session_id)
+    except QueueFullError as e:
+        return JSONResponse(content={"message": str(e)}, status_code=503)
 
-        # Create a new dictionary for the response payload
-        response_payload = mixtral_ai_response.copy() # Start with the AI's structured response
-        response_payload["task_id"] = server_task_id # Add the server-generated task_id
+    return {"task_id": server_task_id, "status": "queued"}
 
-        return response_payload
-    except Exception as e:
-        print(f"Error processing task: {str(e)}")
-        return {"message": "An error occurred while processing the task."}
+@app.post("/process/stream")
+async def process_input_stream(input_data: InputData):
+    """Queue a task on the worker pool and stream its progress as Server-Sent Events."""
+    server_task_id = str(uuid.uuid4())
+    events = asyncio.Queue()
 
-@app.get("/task-history")
-async def get_task_history():
-    tasks = []
-    for filename in glob.glob("task_*.xml"):
+    async def on_finish(job):
+        if job["status"] == COMPLETED:
+            await events.put({"event": "result", **job["result"], "task_id": server_task_id})
+        else:
+            await events.put({"event": "error", "message": "An error occurred while processing the task."})
+        await events.put(None)
+
+    try:
+        job_queue.submit(server_task_id, input_data.user_input, on_finish=on_finish, on_event=events.put,
+                         session_id=input_data.session_id)
+    except QueueFullError as e:
+        return JSONResponse(content={"message": str(e)}, status_code=503)
+
+    async def event_stream():
         try:
-            task_id = filename.replace("task_", "").replace(".xml", "")
-            tasks.append({"id": task_id})
-        except Exception as e:
-            # Log error or handle cases where filename might not be as expected
-            print(f"Error processing filename {filename}: {e}")
-    return {"tasks": tasks}
+            yield format_sse({"event": "task", "task_id": server_task_id, "status": "queued"})
+            while True:
+                event = await events.get()
+                if event is None:
+                    break
+                yield format_sse(event)
+        finally:
+            # Stop generating if the client went away mid-stream
+            job_queue.cancel(server_task_id)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.post("/process/batch")
+async def process_batch(request: Request):
+    """Run many tasks through the worker pool and stream one JSON line per task as each finishes.
+
+    The body is a JSON list of InputData, {"items": [...]}, or JSONL with one item per line.
+    """
+    try:
+        items = parse_batch(await request.body())
+    except ValueError as e:
+        return JSONResponse(content={"message": str(e)}, status_code=400)
+
+    results = asyncio.Queue()
+    # Bounds how much of the shared job queue one batch can take
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    server_task_ids = []
+
+    async def feed():
+        for index, item in enumerate(items):
+            await semaphore.acquire()
+            server_task_id = str(uuid.uuid4())
+            server_task_ids.append(server_task_id)
+
+            async def on_finish(job, index=index, item=item):
+                semaphore.release()
+                await results.put(batch_result(index, item, job))
+
+            await job_queue.enqueue(server_task_id, item["user_input"], on_finish=on_finish,
+                                    session_id=item["session_id"])
+
+    async def result_stream():
+        feeder = asyncio.create_task(feed())
+        completed = 0
+        try:
+            for _ in items:
+                result = await results.get()
+                completed += result["status"] == COMPLETED
+                yield json.dumps(result) + "\n"
+            yield json.dumps({"done": True, "completed": completed, "failed": len(items) - completed}) + "\n"
+        finally:
+            # Stop the rest of the batch if the client went away
+            feeder.cancel()
+            for server_task_id in server_task_ids:
+                job_queue.cancel(server_task_id)
+
+    return StreamingResponse(result_stream(), media_type="application/x-ndjson",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def parse_batch(body):
+    """Parse a /process/batch body into items with task_id, user_input and session_id.
+
+    JSONL lines may also use the requests.jsonl shape, where request_id and body
+    stand in for task_id and user_input.
+    """
+    text = body.decode("utf-8").strip()
+    try:
+        data = json.loads(text)
+        records = data.get("items") if isinstance(data, dict) else data
+        if not isinstance(records, list):
+            records = [data]
+    except json.JSONDecodeError:
+        records = []
+        for line_number, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                raise ValueError(f"Invalid JSON on line {line_number}")
+
+    if not records:
+        raise ValueError("Batch is empty")
+    if len(records) > BATCH_MAX_ITEMS:
+        raise ValueError(f"Batch has {len(records)} items, the limit is {BATCH_MAX_ITEMS}")
+
+    items = []
+    for index, record in enumerate(records):
+        user_input = record.get("user_input", record.get("body")) if isinstance(record, dict) else None
+        if not isinstance(user_input, str) or not user_input:
+            raise ValueError(f"Item {index} has no user_input")
+        items.append({"task_id": record.get("task_id", record.get("request_id", index)),
+                      "user_input": user_input,
+                      "session_id": record.get("session_id")})
+    return items
+
+def batch_result(index, item, job):
+    result = {"index": index, "task_id": item["task_id"], "server_task_id": job["task_id"],
+              "status": job["status"], "input_tokens": job["input_tokens"], "output_tokens": job["output_tokens"]}
+    if job["status"] == COMPLETED:
+        result["result"] = job["result"]
+    else:
+        result["error"] = job["error"]
+    return result
+
+def format_sse(event):
+    return f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+
+@app.get("/tasks/{task_id}")
+async def get_task_status(task_id: str):
+    job = await job_queue.lookup(task_id)
+    if job is None:
+        return JSONResponse(content={"message": "Task not found."}, status_code=404)
+
+    return {
+        "task_id": task_id,
+        "status": job["status"],
+        "iteration": job["iteration"],
+        "max_iterations": MAX_ITERATIONS,
+        "input_tokens": job["input_tokens"],
+        "output_tokens": job["output_tokens"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+    }
+
+@app.get("/tasks/{task_id}/result")
+async def get_task_result(task_id: str):
+    job = await job_queue.lookup(task_id)
+    if job is None:
+        return JSONResponse(content={"message": "Task not found."}, status_code=404)
+    if job["status"] == FAILED:
+        return JSONResponse(content={"task_id": task_id, "status": job["status"],
+                                     "message": "An error occurred while processing the task."},
+                            status_code=500)
+    if job["status"] != COMPLETED:
+        return JSONResponse(content={"task_id": task_id, "status": job["status"]}, status_code=202)
+
+    response_payload = job["result"].copy()
+    response_payload["task_id"] = task_id
+    response_payload["status"] = job["status"]
+    return response_payload
+
+@app.get("/task-history")
+async def get_task_history(limit: int = Query(50, ge=1, le=500), before: Optional[str] = None,
+                           since: Optional[float] = None, until: Optional[float] = None):
+    """List stored tasks newest first; pass next_before back as `before` for the next page."""
+    try:
+        tasks, next_before = await asyncio.to_thread(task_store.list, limit, before, since, until)
+    except ValueError:
+        return JSONResponse(content={"message": "Invalid cursor"}, status_code=400)
+    return {"tasks": tasks, "next_before": next_before}
+
+@app.get("/task-history/{task_id}")
+async def get_task_record(task_id: str):
+    task = await asyncio.to_thread(task_store.get, task_id)
+    if task is None:
+        return JSONResponse(content={"message": "Task not found."}, status_code=404)
+    return task
@@ -0,0 +1,150 @@
+# memory.py
+
+import os
+import random
+import threading
+from collections import OrderedDict
+from apis.tokens import heuristic_count
+
+SHORT_MEMORY_SIZE = int(os.environ.get("SHORT_MEMORY_SIZE", 5))
+LONG_MEMORY_SIZE = int(os.environ.get("LONG_MEMORY_SIZE", 200))
+LONG_MEMORY_TOKENS = int(os.environ.get("LONG_MEMORY_TOKENS", 8000))
+MEMORY_SAMPLE_SIZE = int(os.environ.get("MEMORY_SAMPLE_SIZE", 3))
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", 1000))
+# How long an idle session's memory is kept in the shared state store (seconds)
+SESSION_TTL = float(os.environ.get("SESSION_TTL", 86400))
+
+
+class RingBuffer:
+    """Fixed-capacity buffer with O(1) append, eviction of the oldest item and random access."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._items = [None] * capacity
+        self._start = 0
+        self._size = 0
+
+    def append(self, item):
+        """Append an item, returning the evicted oldest item if the buffer was full."""
+        evicted = None
+        end = (self._start + self._size) % self.capacity
+        if self._size == self.capacity:
+            evicted = self._items[self._start]
+            self._start = (self._start + 1) % self.capacity
+        else:
+            self._size += 1
+        self._items[end] = item
+        return evicted
+
+    def popleft(self):
+        item = self._items[self._start]
+        self._items[self._start] = None
+        self._start = (self._start + 1) % self.capacity
+        self._size -= 1
+        return item
+
+    def __getitem__(self, index):
+        if not 0 <= index < self._size:
+            raise IndexError("RingBuffer index out of range")
+        return self._items[(self._start + index) % self.capacity]
+
+    def __len__(self):
+        return self._size
+
+    def __iter__(self):
+        return (self[i] for i in range(self._size))
+
+    def sample(self, k):
+        """Return up to k distinct items, oldest first, in O(k) regardless of buffer size."""
+        k = min(k, self._size)
+        indexes = sorted(random.sample(range(self._size), k))
+        return [self[i] for i in indexes]
+
+
+class ConversationMemory:
+    """Short- and long-term internal monologue memory for a single session.
+
+    Short memory keeps the last SHORT_MEMORY_SIZE entries. Long memory keeps at
+    most LONG_MEMORY_SIZE entries and LONG_MEMORY_TOKENS estimated tokens,
+    evicting the oldest entries first.
+    """
+
+    def __init__(self, short_size=SHORT_MEMORY_SIZE, long_size=LONG_MEMORY_SIZE, long_tokens=LONG_MEMORY_TOKENS):
+        self.short = RingBuffer(short_size)
+        self.long = RingBuffer(long_size)
+        self.long_tokens = long_tokens
+        self.long_token_count = 0
+
+    def add(self, entry):
+        if not entry:
+            return
+        self.short.append(entry)
+        self._add_long(entry)
+
+    def _add_long(self, entry):
+        evicted = self.long.append(entry)
+        self.long_token_count += heuristic_count(entry)
+        if evicted is not None:
+            self.long_token_count -= heuristic_count(evicted)
+        while self.long_token_count > self.long_tokens and len(self.long) > 1:
+            self.long_token_count -= heuristic_count(self.long.popleft())
+
+    def to_dict(self):
+        return {"short": list(self.short), "long": list(self.long)}
+
+    @classmethod
+    def from_dict(cls, data):
+        memory = cls()
+        for entry in data.get("short", []):
+            memory.short.append(entry)
+        for entry in data.get("long", []):
+            memory._add_long(entry)
+        return memory
+
+    def sample(self, k=MEMORY_SAMPLE_SIZE):
+        """Return (long_sample, short_sample), each holding between 1 and k entries when non-empty."""
+        long_sample = self.long.sample(random.randint(1, k)) if len(self.long) else []
+        short_sample = self.short.sample(random.randint(1, k)) if len(self.short) else []
+        return long_sample, short_sample
+
+
+class MemoryStore:
+    """Per-session ConversationMemory objects, evicting the least recently used session.
+
+    With a shared `state` store (see state.py) sessions are loaded from and saved
+    to the store instead, so any worker can continue a session; idle sessions
+    expire after SESSION_TTL seconds.
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS, state=None, ttl=SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.state = state
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        with self._lock:
+            memory = self._sessions.get(session_id)
+            if memory is None:
+                memory = ConversationMemory()
+                self._sessions[session_id] = memory
+                if len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            else:
+                self._sessions.move_to_end(session_id)
+            return memory
+
+    async def load(self, session_id):
+        if self.state is None:
+            return self.get(session_id)
+        data = await self.state.get(f"memory:{session_id}")
+        return ConversationMemory.from_dict(data) if data else ConversationMemory()
+
+    async def save(self, session_id, memory):
+        """Write a session back to the shared store; in-process memory is already up to date."""
+        if self.state is not None:
+            await self.state.set(f"memory:{session_id}", memory.to_dict(), self.ttl)
+
+    def __len__(self):
+        return len(self._sessions)
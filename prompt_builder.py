@@ -0,0 +1,72 @@
+# prompt_builder.py
+
+from apis.tokens import heuristic_count
+from rate_limit import model_entry
+
+
+def _normalize(fragment):
+    return " ".join(fragment.split()).lower()
+
+
+def prompt_budget(config, provider, model, max_tokens, user_tokens):
+    """Tokens available for the system prompt of one call to provider/model.
+
+    An explicit `prompt_token_budget` on the model's apis/config.json entry wins;
+    otherwise it is whatever `context_window` leaves after the user message and
+    the completion. Returns None when neither is configured (no trimming).
+    """
+    entry = model_entry(config, provider, model)
+    if "prompt_token_budget" in entry:
+        return entry["prompt_token_budget"]
+    if "context_window" in entry:
+        return max(entry["context_window"] - max_tokens - user_tokens, 0)
+    return None
+
+
+class PromptBuilder:
+    """Assembles the Mixtral system prompt from a fixed base and prioritized context sections.
+
+    The base prompt is always kept intact. Sections are added in the order given,
+    fragment by fragment, skipping duplicates and any fragment that would push
+    the prompt past the token budget.
+    """
+
+    def __init__(self, base_prompt, count_tokens=heuristic_count):
+        self.base_prompt = base_prompt
+        self.count_tokens = count_tokens
+        self.base_tokens = count_tokens(base_prompt)
+
+    def build(self, sections, budget=None):
+        """Build the prompt from (name, fragments) pairs, highest priority first.
+
+        Returns (prompt, report) where report maps each section name to the tokens
+        it contributed, plus "base", "total", "budget" and "dropped" (fragments
+        that did not fit).
+        """
+        report = {"base": self.base_tokens}
+        used = self.base_tokens
+        dropped = 0
+        seen = set()
+        parts = [self.base_prompt]
+
+        for name, fragments in sections:
+            section_tokens = 0
+            for fragment in fragments:
+                key = _normalize(fragment)
+                if not key or key in seen:
+                    continue
+                seen.add(key)
+
+                fragment_tokens = self.count_tokens(fragment) + 1  # joining space
+                if budget is not None and used + fragment_tokens > budget:
+                    dropped += 1
+                    continue
+                parts.append(fragment)
+                used += fragment_tokens
+                section_tokens += fragment_tokens
+            report[name] = section_tokens
+
+        report["total"] = used
+        report["budget"] = budget
+        report["dropped"] = dropped
+        return " ".join(parts), report
@@ -0,0 +1,210 @@
+# rate_limit.py
+
+import asyncio
+import threading
+import time
+
+# Maps the provider names used by the orchestrator to their apis/config.json sections
+PROVIDER_SECTIONS = {
+    "claude": "CLAUDE_MODELS",
+    "gemini": "GEMINI_MODELS",
+    "local": "LOCAL_MODELS",
+    "monster": "MONSTER_MODELS",
+    "openai": "OPENAI_MODELS",
+    "perplexity": "PERPLEXITY_MODELS",
+}
+
+
+def model_entry(config, provider, model):
+    """Return a model's apis/config.json entry, or {} if it isn't configured."""
+    return config.get(PROVIDER_SECTIONS.get(provider, ""), {}).get(model, {})
+
+
+class TokenBucket:
+    """Token bucket holding up to `capacity` units, refilled continuously over `period` seconds."""
+
+    def __init__(self, capacity, period=60.0):
+        self.capacity = float(capacity)
+        self.refill_rate = self.capacity / period
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.refill_rate)
+        self.updated = now
+
+    def try_take(self, amount):
+        """Take `amount` units if available; otherwise return the seconds until they will be."""
+        # A request larger than the bucket could never fit, so cap it at a full bucket
+        amount = min(amount, self.capacity)
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.level >= amount:
+                self.level -= amount
+                return 0.0
+            return (amount - self.level) / self.refill_rate
+
+    async def take(self, amount):
+        return self.try_take(amount)
+
+    def available(self):
+        """Fraction of the bucket currently available, without taking anything."""
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0.0, self.level) / self.capacity
+
+    def adjust(self, amount):
+        """Return (positive) or charge (negative) units after the fact; the level may go negative."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.level = min(self.capacity, self.level + amount)
+
+
+class SharedTokenBucket(TokenBucket):
+    """TokenBucket kept in the shared state store, so every worker draws from the same bucket.
+
+    The inherited local level mirrors the store's as of the last call and only
+    serves available(); adjustments are written to the store in the background.
+    """
+
+    def __init__(self, state, key, capacity, period=60.0):
+        super().__init__(capacity, period)
+        self.state = state
+        self.key = key
+        self.period = period
+
+    async def take(self, amount):
+        amount = min(amount, self.capacity)
+        wait_time, level = await self.state.take(self.key, self.capacity, self.period, amount)
+        self._mirror(level)
+        return wait_time
+
+    def adjust(self, amount):
+        super().adjust(amount)
+        self.state.run_soon(self._adjust(amount))
+
+    async def _adjust(self, amount):
+        self._mirror(await self.state.adjust(self.key, self.capacity, self.period, amount))
+
+    def _mirror(self, level):
+        with self._lock:
+            self.level = level
+            self.updated = time.monotonic()
+
+
+class Reservation:
+    def __init__(self, key, tokens, wait_time):
+        self.key = key
+        self.tokens = tokens
+        self.wait_time = wait_time
+
+
+class RateLimiter:
+    """Per-(provider, model) request and token buckets, plus optional per-provider ones.
+
+    Limits come from `requests_per_minute` / `tokens_per_minute` on the model's
+    entry in apis/config.json, falling back to the global defaults. Each key has
+    its own buckets, so traffic to one provider never throttles another. A
+    provider listed under PROVIDER_LIMITS in apis/config.json also gets a
+    shared pair of buckets that all of its models draw from, for accounts
+    whose quota covers every model.
+
+    With a shared `state` store (see state.py) the buckets live in the store and
+    the limits hold across every worker; the counters in stats() stay per worker.
+    """
+
+    def __init__(self, config, requests_per_minute, tokens_per_minute, state=None):
+        self.config = config
+        self.state = state
+        self.default_requests_per_minute = requests_per_minute
+        self.default_tokens_per_minute = tokens_per_minute
+        self._buckets = {}
+        self._provider_buckets = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def limits_for(self, provider, model):
+        entry = model_entry(self.config, provider, model)
+        return (entry.get("requests_per_minute", self.default_requests_per_minute),
+                entry.get("tokens_per_minute", self.default_tokens_per_minute))
+
+    def _buckets_for(self, key):
+        with self._lock:
+            buckets = self._buckets.get(key)
+            if buckets is None:
+                requests_per_minute, tokens_per_minute = self.limits_for(*key)
+                name = "/".join(key)
+                buckets = (self._new_bucket(f"{name}:requests", requests_per_minute),
+                           self._new_bucket(f"{name}:tokens", tokens_per_minute))
+                self._buckets[key] = buckets
+                self._stats[key] = {"requests": 0, "tokens": 0, "waits": 0, "wait_seconds": 0.0}
+            return buckets
+
+    def _provider_buckets_for(self, provider):
+        """Return the provider-wide (request, token) buckets, or None if the provider has no shared limit."""
+        with self._lock:
+            if provider not in self._provider_buckets:
+                limits = self.config.get("PROVIDER_LIMITS", {}).get(provider)
+                buckets = None
+                if limits:
+                    buckets = (self._new_bucket(f"{provider}:requests",
+                                                limits.get("requests_per_minute", self.default_requests_per_minute)),
+                               self._new_bucket(f"{provider}:tokens",
+                                                limits.get("tokens_per_minute", self.default_tokens_per_minute)))
+                self._provider_buckets[provider] = buckets
+            return self._provider_buckets[provider]
+
+    def _new_bucket(self, name, capacity):
+        if self.state is None:
+            return TokenBucket(capacity)
+        return SharedTokenBucket(self.state, f"ratelimit:{name}", capacity)
+
+    def _all_buckets(self, provider, model):
+        """Request buckets and token buckets that a call to provider/model draws from."""
+        request_bucket, token_bucket = self._buckets_for((provider, model))
+        provider_buckets = self._provider_buckets_for(provider)
+        if provider_buckets is None:
+            return [request_bucket], [token_bucket]
+        return [request_bucket, provider_buckets[0]], [token_bucket, provider_buckets[1]]
+
+    async def acquire(self, provider, model, estimated_tokens):
+        """Wait for one request slot plus `estimated_tokens` and return the reservation."""
+        key = (provider, model)
+        request_buckets, token_buckets = self._all_buckets(provider, model)
+        start = time.monotonic()
+
+        for bucket, amount in [(bucket, 1) for bucket in request_buckets] + \
+                              [(bucket, estimated_tokens) for bucket in token_buckets]:
+            while True:
+                wait_time = await bucket.take(amount)
+                if wait_time == 0:
+                    break
+                await asyncio.sleep(wait_time)
+
+        waited = time.monotonic() - start
+        with self._lock:
+            stats = self._stats[key]
+            stats["requests"] += 1
+            stats["tokens"] += estimated_tokens
+            if waited > 0.001:
+                stats["waits"] += 1
+                stats["wait_seconds"] += waited
+        return Reservation(key, estimated_tokens, waited)
+
+    def reconcile(self, reservation, actual_tokens):
+        """Correct the token bucket once the provider has reported actual usage."""
+        _, token_buckets = self._all_buckets(*reservation.key)
+        for token_bucket in token_buckets:
+            token_bucket.adjust(reservation.tokens - actual_tokens)
+        with self._lock:
+            self._stats[reservation.key]["tokens"] += actual_tokens - reservation.tokens
+
+    def headroom(self, provider, model):
+        """Fraction (0-1) of the tighter of the request and token buckets still available."""
+        request_buckets, token_buckets = self._all_buckets(provider, model)
+        return min(bucket.available() for bucket in request_buckets + token_buckets)
+
+    def stats(self):
+        with self._lock:
+            return {f"{provider}/{model}": dict(stats) for (provider, model), stats in self._stats.items()}
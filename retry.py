@@ -0,0 +1,53 @@
+# retry.py
+
+import asyncio
+import os
+import random
+
+import httpx
+
+# Per-attempt deadline for provider calls; a model's "timeout" in apis/config.json overrides it
+PROVIDER_TIMEOUT = float(os.environ.get("PROVIDER_TIMEOUT", 60))
+PROVIDER_MAX_RETRIES = int(os.environ.get("PROVIDER_MAX_RETRIES", 2))
+# Full-jitter exponential backoff: attempt n sleeps uniformly in [0, min(max, base * 2**n)]
+PROVIDER_RETRY_BACKOFF = float(os.environ.get("PROVIDER_RETRY_BACKOFF", 0.5))
+PROVIDER_RETRY_MAX_BACKOFF = float(os.environ.get("PROVIDER_RETRY_MAX_BACKOFF", 8))
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+def is_retryable(error):
+    """Timeouts, dropped connections, rate limiting and 5xx responses are worth retrying; nothing else is."""
+    if isinstance(error, (asyncio.TimeoutError, ConnectionError, httpx.TransportError)):
+        return True
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES
+    # SDK connection/timeout errors (openai, anthropic) carry no status code
+    return any(cls.__name__ == "APIConnectionError" for cls in type(error).__mro__)
+
+
+def backoff_delay(attempt, base=PROVIDER_RETRY_BACKOFF, cap=PROVIDER_RETRY_MAX_BACKOFF):
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+async def call_with_retries(make_call, timeout=PROVIDER_TIMEOUT, max_retries=PROVIDER_MAX_RETRIES,
+                            should_retry=is_retryable):
+    """Await make_call() with a per-attempt deadline, retrying retryable errors with jittered backoff.
+
+    make_call must return a fresh coroutine each time it is called.
+    """
+    attempt = 0
+    while True:
+        try:
+            async with asyncio.timeout(timeout):
+                return await make_call()
+        except Exception as e:
+            if attempt >= max_retries or not should_retry(e):
+                raise
+            delay = backoff_delay(attempt)
+            print(f"Retrying after {type(e).__name__} (attempt {attempt + 1} of {max_retries}) in {delay:.2f}s")
+            attempt += 1
+            await asyncio.sleep(delay)
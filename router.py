@@ -0,0 +1,376 @@
+# router.py
+
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+
+from apis.cache import cached_only, is_cached
+from apis.tokens import count_message_tokens
+from rate_limit import model_entry
+from retry import PROVIDER_TIMEOUT, call_with_retries, is_retryable
+
+# Candidate models for the orchestrator as "provider/model" keys of apis/config.json
+ROUTER_MODELS = os.environ.get(
+    "ROUTER_MODELS",
+    "local/mixtral-8x7b-local,openai/gpt-3.5-turbo-0125,perplexity/mixtral-8x7b-instruct,claude/haiku",
+)
+# Number of recent calls per model used for latency percentiles and error rates
+ROUTER_WINDOW = int(os.environ.get("ROUTER_WINDOW", 50))
+# Score penalties, in cost tiers ("$" in config.json), per second of p95 latency and per unit error rate
+ROUTER_LATENCY_WEIGHT = float(os.environ.get("ROUTER_LATENCY_WEIGHT", 0.5))
+ROUTER_ERROR_WEIGHT = float(os.environ.get("ROUTER_ERROR_WEIGHT", 4.0))
+# Models with less than this fraction of their rate limit left count as saturated
+ROUTER_MIN_HEADROOM = float(os.environ.get("ROUTER_MIN_HEADROOM", 0.1))
+# Consecutive failures after which a model is skipped for ROUTER_COOLDOWN seconds
+ROUTER_MAX_FAILURES = int(os.environ.get("ROUTER_MAX_FAILURES", 3))
+ROUTER_COOLDOWN = float(os.environ.get("ROUTER_COOLDOWN", 30))
+# Hedged requests: if the chosen model hasn't answered after its p95 latency (at least
+# ROUTER_HEDGE_MIN_DELAY seconds), send the same request to the next candidate and keep the first answer
+ROUTER_HEDGE = os.environ.get("ROUTER_HEDGE", "false").lower() == "true"
+ROUTER_HEDGE_MIN_DELAY = float(os.environ.get("ROUTER_HEDGE_MIN_DELAY", 1.0))
+
+# Environment variable holding each provider's API key; providers without a key are not routed to
+PROVIDER_API_KEYS = {
+    "claude": "CLAUDE_API_KEY",
+    "gemini": "GOOGLE_API_KEY",
+    "monster": "MONSTER_API_KEY",
+    "openai": "OPENAI_API_KEY",
+    "perplexity": "PERPLEXITY_API_KEY",
+}
+
+
+def parse_models(spec):
+    """Parse "provider/model,provider/model" into a list of (provider, model) pairs."""
+    models = []
+    for item in spec.split(","):
+        provider, _, model = item.strip().partition("/")
+        if provider and model:
+            models.append((provider, model))
+    return models
+
+
+class ChatAdapter:
+    """Adapter for apis/ classes whose process_* method takes chat messages (openai, local, perplexity, monster)."""
+
+    def __init__(self, model, method_name):
+        self.model = model
+        self.method_name = method_name
+
+    def cacheable(self):
+        return is_cached(getattr(self.model, self.method_name))
+
+    async def complete(self, model_key, messages, temperature, max_tokens, on_token=None):
+        method = getattr(self.model, self.method_name)
+        return await method(model_key, messages, temperature, max_tokens, on_token=on_token)
+
+
+class ClaudeAdapter:
+    def __init__(self, model):
+        self.model = model
+
+    def cacheable(self):
+        return is_cached(self.model.process_claude_model)
+
+    async def complete(self, model_key, messages, temperature, max_tokens, on_token=None):
+        system_prompt = "\n\n".join(m["content"] for m in messages if m["role"] == "system")
+        user_input = "\n\n".join(m["content"] for m in messages if m["role"] != "system")
+        return await self.model.process_claude_model(model_key, temperature, system_prompt, user_input, max_tokens,
+                                                     on_token=on_token)
+
+
+class GeminiAdapter:
+    """Gemini takes a single prompt and doesn't stream, so the response is forwarded as one chunk."""
+
+    def __init__(self, model):
+        self.model = model
+
+    def cacheable(self):
+        return is_cached(self.model.process_gemini_model)
+
+    async def complete(self, model_key, messages, temperature, max_tokens, on_token=None):
+        prompt = "\n\n".join(m["content"] for m in messages)
+        content, input_tokens, output_tokens = await self.model.process_gemini_model(
+            model_key, prompt, temperature, max_tokens)
+        if on_token is not None and content:
+            await on_token(content)
+        return content, input_tokens, output_tokens
+
+
+def create_adapter(provider):
+    """Instantiate the apis/ class for `provider` behind its adapter.
+
+    Returns None if the provider's API key isn't set or its SDK can't be loaded.
+    """
+    key_name = PROVIDER_API_KEYS.get(provider)
+    if key_name and not os.environ.get(key_name):
+        return None
+    try:
+        if provider == "openai":
+            from apis.openai import OpenAIModel
+            return ChatAdapter(OpenAIModel(), "process_openai_model")
+        if provider == "perplexity":
+            from apis.perplexity import PerplexityModel
+            return ChatAdapter(PerplexityModel(), "process_perplexity_model")
+        if provider == "local":
+            from apis.local import LocalModel
+            return ChatAdapter(LocalModel(), "process_local_model")
+        if provider == "claude":
+            from apis.claude_3 import Claude3
+            return ClaudeAdapter(Claude3())
+        if provider == "monster":
+            from apis.monster import MonsterAPI
+            return ChatAdapter(MonsterAPI(), "process_monster_model")
+        if provider == "gemini":
+            from apis.gemini import GeminiModel
+            return GeminiAdapter(GeminiModel())
+    except Exception as e:
+        print(f"Error initializing provider {provider}: {e}")
+    return None
+
+
+class ModelStats:
+    """Rolling latency and outcome window for one (provider, model)."""
+
+    def __init__(self, window=ROUTER_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.consecutive_failures = 0
+        self.cancelled = 0
+        self.open_until = 0.0
+
+    def record(self, latency, ok):
+        self.outcomes.append(ok)
+        if ok:
+            self.latencies.append(latency)
+            self.consecutive_failures = 0
+        else:
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= ROUTER_MAX_FAILURES:
+                self.open_until = time.monotonic() + ROUTER_COOLDOWN
+
+    def record_cancelled(self, latency):
+        """A call abandoned after `latency` seconds: a lower bound on its latency, and not an error."""
+        self.cancelled += 1
+        self.latencies.append(latency)
+
+    def percentile(self, fraction):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def cooling_down(self):
+        return time.monotonic() < self.open_until
+
+
+class Router:
+    """Picks a model per call from cost, live latency/error stats and rate-limit headroom.
+
+    Candidates are scored as cost tier + weighted p95 latency + weighted error
+    rate, so cheap/local models win while they are healthy. Models that are
+    cooling down after repeated failures, saturated, or too small for the
+    request are tried only after every other candidate. Each attempt has a
+    deadline and retries retryable errors; a call that still fails fails over
+    to the next candidate unless it had already streamed tokens. With hedging
+    on, slow non-streaming calls are duplicated to the next candidate if it
+    is healthy and no more expensive.
+    """
+
+    def __init__(self, config, rate_limiter, adapters, models, preferred_provider=None, hedge=ROUTER_HEDGE,
+                 hedge_min_delay=ROUTER_HEDGE_MIN_DELAY):
+        self.config = config
+        self.rate_limiter = rate_limiter
+        self.adapters = adapters
+        self.models = [(provider, model) for provider, model in models
+                       if provider in adapters and model_entry(config, provider, model)]
+        if not self.models:
+            raise ValueError("No routable models: check ROUTER_MODELS and provider API keys")
+        self.preferred_provider = preferred_provider
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.hedges_sent = 0
+        self.hedges_won = 0
+        self._stats = {key: ModelStats() for key in self.models}
+        self._lock = threading.Lock()
+
+    def primary(self):
+        """The model the router prefers when every candidate is healthy."""
+        return self.candidates()[0]
+
+    def cost(self, provider, model):
+        return len(model_entry(self.config, provider, model).get("cost", "$$$"))
+
+    def estimated_price(self, provider, model, input_tokens, output_tokens):
+        entry = model_entry(self.config, provider, model)
+        return (input_tokens * entry.get("input_price_per_million", 0)
+                + output_tokens * entry.get("output_price_per_million", 0)) / 1e6
+
+    def score(self, provider, model):
+        stats = self._stats[(provider, model)]
+        with self._lock:
+            p95 = stats.percentile(0.95)
+            error_rate = stats.error_rate()
+        return self.cost(provider, model) + ROUTER_LATENCY_WEIGHT * p95 + ROUTER_ERROR_WEIGHT * error_rate
+
+    def candidates(self, messages=None, max_tokens=0):
+        """Return the candidate models for a request, best first."""
+        ranked = []
+        for provider, model in self.models:
+            entry = model_entry(self.config, provider, model)
+            input_tokens = count_message_tokens(entry.get("tokenizer"), messages) if messages else 0
+            fits = input_tokens + max_tokens <= entry.get("context_window", float("inf"))
+            with self._lock:
+                healthy = not self._stats[(provider, model)].cooling_down()
+            available = self.rate_limiter.headroom(provider, model) >= ROUTER_MIN_HEADROOM
+            ranked.append(((not fits, not healthy, not available, provider != self.preferred_provider,
+                            self.score(provider, model),
+                            self.estimated_price(provider, model, input_tokens, max_tokens)),
+                           (provider, model)))
+        ranked.sort(key=lambda item: item[0])
+        return [key for _, key in ranked]
+
+    async def complete(self, messages, temperature, max_tokens, on_token=None):
+        """Run the request on the best candidate, failing over on errors.
+
+        Returns (content, input_tokens, output_tokens, (provider, model)).
+        """
+        streamed = []
+
+        async def forward(text):
+            streamed.append(True)
+            await on_token(text)
+
+        def should_retry(error):
+            # Tokens already sent to the caller can't be taken back
+            return not streamed and is_retryable(error)
+
+        call = (messages, temperature, max_tokens, forward if on_token is not None else None, should_retry)
+        candidates = self.candidates(messages, max_tokens)
+        tried = set()
+        last_error = None
+        for index, (provider, model) in enumerate(candidates):
+            if (provider, model) in tried:
+                continue
+            tried.add((provider, model))
+            backup = candidates[index + 1] if index + 1 < len(candidates) else None
+            try:
+                if on_token is None and self.can_hedge((provider, model), backup):
+                    return await self._hedged((provider, model), backup, call, tried)
+                return await self._attempt(provider, model, *call)
+            except Exception as e:
+                print(f"Router: {provider}/{model} failed: {e}")
+                last_error = e
+                if streamed:
+                    raise
+
+        raise last_error
+
+    def can_hedge(self, primary, backup):
+        if not self.hedge or backup is None:
+            return False
+        with self._lock:
+            healthy = not self._stats[backup].cooling_down()
+        return healthy and self.cost(*backup) <= self.cost(*primary)
+
+    def timeout_for(self, provider, model):
+        return model_entry(self.config, provider, model).get("timeout", PROVIDER_TIMEOUT)
+
+    async def _attempt(self, provider, model, messages, temperature, max_tokens, on_token, should_retry):
+        """One call to one model under its deadline and retry policy, recorded in the stats and rate limiter.
+
+        Cached responses are returned before any rate-limit capacity is reserved.
+        """
+        adapter = self.adapters[provider]
+
+        def make_call():
+            return adapter.complete(model, messages, temperature, max_tokens, on_token=on_token)
+
+        if getattr(adapter, "cacheable", lambda: False)():
+            result = await cached_only(make_call)
+            if result is not None:
+                return (*result, (provider, model))
+
+        tokenizer = model_entry(self.config, provider, model).get("tokenizer")
+        reservation = await self.rate_limiter.acquire(
+            provider, model, count_message_tokens(tokenizer, messages) + max_tokens)
+        start = time.monotonic()
+        try:
+            content, input_tokens, output_tokens = await call_with_retries(
+                make_call, self.timeout_for(provider, model), should_retry=should_retry)
+        except asyncio.CancelledError:
+            # A hedge that lost the race, or a cancelled caller: the prompt was sent, the completion wasn't
+            self.record_cancelled(provider, model, time.monotonic() - start)
+            self.rate_limiter.reconcile(reservation, reservation.tokens - max_tokens)
+            raise
+        except Exception:
+            self.record(provider, model, time.monotonic() - start, False)
+            self.rate_limiter.reconcile(reservation, 0)
+            raise
+
+        self.record(provider, model, time.monotonic() - start, True)
+        self.rate_limiter.reconcile(reservation, input_tokens + output_tokens)
+        return content, input_tokens, output_tokens, (provider, model)
+
+    async def _hedged(self, primary, backup, call, tried):
+        """Run primary; if it is still running after its p95 latency, race it against backup.
+
+        backup is added to `tried` once it has been sent, so a failed race doesn't retry it.
+        """
+        with self._lock:
+            delay = max(self.hedge_min_delay, self._stats[primary].percentile(0.95))
+        pending = {asyncio.ensure_future(self._attempt(*primary, *call))}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return done.pop().result()
+
+            self.hedges_sent += 1
+            tried.add(backup)
+            second = asyncio.ensure_future(self._attempt(*backup, *call))
+            pending.add(second)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedges_won += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # Also reached when the caller is cancelled, so no provider call is left running
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def record_cancelled(self, provider, model, latency):
+        with self._lock:
+            self._stats[(provider, model)].record_cancelled(latency)
+
+    def record(self, provider, model, latency, ok):
+        with self._lock:
+            self._stats[(provider, model)].record(latency, ok)
+
+    def stats(self):
+        with self._lock:
+            models = {
+                f"{provider}/{model}": {
+                    "calls": len(stats.outcomes),
+                    "p50_latency": stats.percentile(0.5),
+                    "p95_latency": stats.percentile(0.95),
+                    "error_rate": stats.error_rate(),
+                    "cancelled": stats.cancelled,
+                    "cooling_down": stats.cooling_down(),
+                }
+                for (provider, model), stats in self._stats.items()
+            }
+        return {"models": models, "hedges_sent": self.hedges_sent, "hedges_won": self.hedges_won}
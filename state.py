@@ -0,0 +1,110 @@
+# state.py
+
+import asyncio
+import json
+import os
+from collections import deque
+
+# "local" keeps all state in process; "redis" shares it through a Redis-protocol store
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "local").lower()
+STATE_REDIS_URL = os.environ.get("STATE_REDIS_URL", "redis://localhost:6379/0")
+STATE_KEY_PREFIX = os.environ.get("STATE_KEY_PREFIX", "siloedboss:")
+
+# Refills and then takes from (or adjusts) a token bucket stored as a hash, in one atomic step.
+# The server clock is used so every worker agrees on the refill. Numbers are returned as
+# strings because Lua numbers come back to the client truncated to integers.
+BUCKET_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local period = tonumber(ARGV[2])
+local amount = tonumber(ARGV[3])
+local rate = capacity / period
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'level', 'updated')
+local level = tonumber(bucket[1]) or capacity
+local updated = tonumber(bucket[2]) or now
+level = math.min(capacity, level + math.max(0, now - updated) * rate)
+local wait = 0
+if ARGV[4] == 'take' then
+    if level >= amount then
+        level = level - amount
+    else
+        wait = (amount - level) / rate
+    end
+else
+    level = math.min(capacity, level + amount)
+end
+redis.call('HSET', KEYS[1], 'level', tostring(level), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(period * 2000))
+return {tostring(wait), tostring(level)}
+"""
+
+
+class RedisState:
+    """State shared by every worker through a Redis-protocol store (Redis, Valkey, KeyDB, ...).
+
+    Values are stored as JSON under STATE_KEY_PREFIX. Token buckets are updated
+    by a server-side script, so rate limits hold across processes and nodes.
+    """
+
+    def __init__(self, url=STATE_REDIS_URL, prefix=STATE_KEY_PREFIX, client=None):
+        if client is None:
+            import redis.asyncio as redis
+            client = redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self._bucket_script = client.register_script(BUCKET_SCRIPT)
+        self._pending = deque()
+        self._drain_task = None
+
+    async def get(self, key):
+        value = await self.client.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    async def set(self, key, value, ttl=None):
+        await self.client.set(self.prefix + key, json.dumps(value), px=int(ttl * 1000) if ttl else None)
+
+    async def delete(self, key):
+        await self.client.delete(self.prefix + key)
+
+    async def take(self, key, capacity, period, amount):
+        """Take `amount` from a bucket if available; returns (seconds until it would be, level after)."""
+        wait_time, level = await self._bucket_script(keys=[self.prefix + key],
+                                                     args=[capacity, period, amount, "take"])
+        return float(wait_time), float(level)
+
+    async def adjust(self, key, capacity, period, amount):
+        """Return (positive) or charge (negative) units to a bucket; returns the level after."""
+        _, level = await self._bucket_script(keys=[self.prefix + key],
+                                             args=[capacity, period, amount, "adjust"])
+        return float(level)
+
+    def run_soon(self, coroutine):
+        """Queue a write for callers that can't await it; queued writes run in order and errors are logged."""
+        self._pending.append(coroutine)
+        if self._drain_task is None or self._drain_task.done():
+            self._drain_task = asyncio.get_running_loop().create_task(self._drain())
+
+    async def _drain(self):
+        while self._pending:
+            try:
+                await self._pending.popleft()
+            except Exception as e:
+                print(f"Shared state write failed: {e}")
+
+    async def aclose(self):
+        if self._drain_task is not None:
+            await self._drain_task
+        await self.client.aclose()
+
+
+def create_state(backend=STATE_BACKEND, url=STATE_REDIS_URL):
+    """Return the shared state store, or None when state is kept in process."""
+    if backend == "redis":
+        return RedisState(url)
+    if backend != "local":
+        print(f"Warning: unknown STATE_BACKEND {backend!r}. Keeping state in process.")
+    return None
+
+
+shared_state = create_state()
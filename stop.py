@@ -0,0 +1,149 @@
+# stop.py
+
+import difflib
+import os
+import time
+
+from tag_parser import FINAL_ANSWER_TAG
+
+# Stop once an iteration's output is at least this similar (0-1) to the previous one; 0 disables
+STOP_SIMILARITY = float(os.environ.get("STOP_SIMILARITY", 0.95))
+# Per-task budgets; 0 disables
+STOP_MAX_TOKENS = int(os.environ.get("STOP_MAX_TOKENS", 0))
+STOP_MAX_COST = float(os.environ.get("STOP_MAX_COST", 0))
+STOP_DEADLINE = float(os.environ.get("STOP_DEADLINE", 0))
+
+MAX_ITERATIONS_REACHED = "max_iterations"
+
+
+class TaskProgress:
+    """What the stop conditions see of a running task, updated after every iteration."""
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.iteration = 0
+        self.content = ""
+        self.previous_content = None
+        self.sections = {}
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cost = 0.0
+
+    def record(self, content, sections, input_tokens, output_tokens, cost):
+        self.iteration += 1
+        self.previous_content = self.content if self.iteration > 1 else None
+        self.content = content
+        self.sections = sections
+        self.input_tokens += input_tokens
+        self.output_tokens += output_tokens
+        self.cost += cost
+
+
+class StopCondition:
+    """Decides when the phase_one loop may stop early.
+
+    check() returns a stop reason or None after each iteration. remaining()
+    returns the seconds the next iteration may take, or None for no limit.
+    """
+
+    reason = "stopped"
+
+    def check(self, progress):
+        return None
+
+    def remaining(self, progress):
+        return None
+
+
+class FinalAnswer(StopCondition):
+    reason = "final_answer"
+
+    def __init__(self, tag=FINAL_ANSWER_TAG):
+        self.tag = tag
+
+    def check(self, progress):
+        return self.reason if progress.sections.get(self.tag) else None
+
+
+class Converged(StopCondition):
+    """Stops once the output stops changing between iterations."""
+
+    reason = "converged"
+
+    def __init__(self, threshold=STOP_SIMILARITY):
+        self.threshold = threshold
+
+    def check(self, progress):
+        if progress.previous_content is None:
+            return None
+        matcher = difflib.SequenceMatcher(None, progress.previous_content, progress.content, autojunk=False)
+        # quick_ratio() is an upper bound on ratio(), so most changed outputs skip the full comparison
+        if matcher.quick_ratio() >= self.threshold and matcher.ratio() >= self.threshold:
+            return self.reason
+        return None
+
+
+class TokenBudget(StopCondition):
+    reason = "token_budget"
+
+    def __init__(self, max_tokens=STOP_MAX_TOKENS):
+        self.max_tokens = max_tokens
+
+    def check(self, progress):
+        return self.reason if progress.input_tokens + progress.output_tokens >= self.max_tokens else None
+
+
+class CostBudget(StopCondition):
+    """Stops once the estimated price (see Router.estimated_price) reaches max_cost."""
+
+    reason = "cost_budget"
+
+    def __init__(self, max_cost=STOP_MAX_COST):
+        self.max_cost = max_cost
+
+    def check(self, progress):
+        return self.reason if progress.cost >= self.max_cost else None
+
+
+class Deadline(StopCondition):
+    """Wall-clock limit for the whole task; an iteration still running at the deadline is cut off."""
+
+    reason = "deadline"
+
+    def __init__(self, seconds=STOP_DEADLINE):
+        self.seconds = seconds
+
+    def check(self, progress):
+        return self.reason if self.remaining(progress) <= 0 else None
+
+    def remaining(self, progress):
+        return self.seconds - (time.monotonic() - progress.started_at)
+
+
+def default_stop_conditions():
+    """Stop conditions enabled by the STOP_* settings."""
+    conditions = [FinalAnswer()]
+    if STOP_SIMILARITY > 0:
+        conditions.append(Converged())
+    if STOP_MAX_TOKENS > 0:
+        conditions.append(TokenBudget())
+    if STOP_MAX_COST > 0:
+        conditions.append(CostBudget())
+    if STOP_DEADLINE > 0:
+        conditions.append(Deadline())
+    return conditions
+
+
+def stop_reason(conditions, progress):
+    """Return the reason of the first condition that says stop, or None."""
+    for condition in conditions:
+        reason = condition.check(progress)
+        if reason is not None:
+            return reason
+    return None
+
+
+def time_remaining(conditions, progress):
+    """Seconds until the earliest deadline among the conditions, or None."""
+    limits = [limit for limit in (condition.remaining(progress) for condition in conditions) if limit is not None]
+    return min(limits) if limits else None
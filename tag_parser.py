@@ -0,0 +1,113 @@
+# tag_parser.py
+
+# Every tag the orchestrator understands in model output
+KNOWN_TAGS = ("Response_to_User", "questions_for_user", "tasks", "wizard_task", "internal_monologue", "final_answer")
+# Empty marker the model adds once its Response_to_User needs no more refinement
+FINAL_ANSWER_TAG = "final_answer"
+
+
+class StreamingTagParser:
+    """Single-pass, incremental parser for <tag>...</tag> sections in model output.
+
+    feed() accepts arbitrary chunks (a tag may be split across chunks) and returns
+    a list of (kind, tag, text) events where kind is "open", "text" or "close".
+    Text outside the known tags is discarded, and markup inside a section is kept
+    verbatim until that section's closing tag. Every completed section is also
+    collected, so finish() returns all occurrences of every tag.
+    """
+
+    def __init__(self, tags=KNOWN_TAGS):
+        self.tags = tuple(tags)
+        self.open_tags = {f"<{tag}>": tag for tag in self.tags}
+        self.sections = {tag: [] for tag in self.tags}
+        self.current_tag = None
+        self._buffer = ""
+        self._section_parts = []
+
+    def feed(self, chunk):
+        events = []
+        self._buffer += chunk
+
+        while self._buffer:
+            if self.current_tag is None:
+                start = self._buffer.find("<")
+                if start == -1:
+                    self._buffer = ""
+                    break
+                self._buffer = self._buffer[start:]
+
+                tag = self._match_open_tag()
+                if tag is None:
+                    if self._could_be_open_tag():
+                        break
+                    # A stray '<' that can't start a known tag
+                    self._buffer = self._buffer[1:]
+                    continue
+
+                self._buffer = self._buffer[len(tag) + 2:]
+                self.current_tag = tag
+                self._section_parts = []
+                events.append(("open", tag, ""))
+            else:
+                end_tag = f"</{self.current_tag}>"
+                end = self._buffer.find(end_tag)
+                if end != -1:
+                    if end:
+                        events.append(("text", self.current_tag, self._buffer[:end]))
+                        self._section_parts.append(self._buffer[:end])
+                    events.append(("close", self.current_tag, ""))
+                    self._end_section()
+                    self._buffer = self._buffer[end + len(end_tag):]
+                    continue
+
+                # Hold back a suffix that might be the start of the closing tag
+                keep = self._partial_suffix(end_tag)
+                text = self._buffer[:len(self._buffer) - keep]
+                if text:
+                    events.append(("text", self.current_tag, text))
+                    self._section_parts.append(text)
+                self._buffer = self._buffer[len(self._buffer) - keep:]
+                break
+
+        return events
+
+    def finish(self):
+        """Return {tag: [section, ...]} for everything fed so far.
+
+        A section left open at the end of the output (e.g. cut off by max_tokens)
+        is kept with whatever text it received.
+        """
+        if self.current_tag is not None:
+            self._section_parts.append(self._buffer)
+            self._buffer = ""
+            self._end_section()
+        return self.sections
+
+    def _end_section(self):
+        text = "".join(self._section_parts).strip()
+        if text:
+            self.sections[self.current_tag].append(text)
+        self._section_parts = []
+        self.current_tag = None
+
+    def _match_open_tag(self):
+        for open_tag, tag in self.open_tags.items():
+            if self._buffer.startswith(open_tag):
+                return tag
+        return None
+
+    def _could_be_open_tag(self):
+        return any(open_tag.startswith(self._buffer) for open_tag in self.open_tags)
+
+    def _partial_suffix(self, end_tag):
+        for size in range(min(len(end_tag) - 1, len(self._buffer)), 0, -1):
+            if end_tag.startswith(self._buffer[-size:]):
+                return size
+        return 0
+
+
+def parse_tags(content, tags=KNOWN_TAGS):
+    """Extract every occurrence of every tag from complete model output in one pass."""
+    parser = StreamingTagParser(tags)
+    parser.feed(content)
+    return parser.finish()
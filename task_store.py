@@ -0,0 +1,253 @@
+# task_store.py
+
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+TASK_DB_PATH = os.environ.get("TASK_DB_PATH", "tasks.db")
+TASK_STORE_BATCH_SIZE = int(os.environ.get("TASK_STORE_BATCH_SIZE", 64))
+TASK_STORE_FLUSH_INTERVAL = float(os.environ.get("TASK_STORE_FLUSH_INTERVAL", 1.0))
+TASK_WRITER_QUEUE_SIZE = int(os.environ.get("TASK_WRITER_QUEUE_SIZE", 10000))
+TASK_HISTORY_MAX_LIMIT = 500
+
+
+class TaskStore:
+    """SQLite (WAL mode) store for completed tasks and their per-iteration stats.
+
+    Tasks are indexed by task_id and (creation time, task_id), iterations by task_id.
+    write_batch() commits any number of rows in a single transaction.
+    """
+
+    def __init__(self, path=TASK_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _connect(self):
+        # Opened on first use (and again after close), so importing creates no file
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                "task_id TEXT PRIMARY KEY, "
+                "created_at REAL NOT NULL, "
+                "user_input TEXT, "
+                "response TEXT, "
+                "stop_reason TEXT)"
+            )
+            # Databases created before stop_reason was recorded
+            columns = [row[1] for row in self._connection.execute("PRAGMA table_info(tasks)")]
+            if "stop_reason" not in columns:
+                self._connection.execute("ALTER TABLE tasks ADD COLUMN stop_reason TEXT")
+            # (created_at, task_id) is the pagination key, so ties on created_at page correctly
+            self._connection.execute("DROP INDEX IF EXISTS idx_tasks_created_at")
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS idx_tasks_created_at_id ON tasks (created_at, task_id)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS task_iterations ("
+                "task_id TEXT NOT NULL, "
+                "iteration INTEGER NOT NULL, "
+                "provider TEXT, "
+                "model TEXT, "
+                "prompt_tokens INTEGER, "
+                "input_tokens INTEGER, "
+                "output_tokens INTEGER, "
+                "latency REAL, "
+                "created_at REAL NOT NULL, "
+                "PRIMARY KEY (task_id, iteration))"
+            )
+            self._connection.commit()
+        return self._connection
+
+    @staticmethod
+    def task_row(task_id, user_input, response, created_at=None, stop_reason=None):
+        return (str(task_id), created_at or time.time(), user_input, json.dumps(response), stop_reason)
+
+    @staticmethod
+    def iteration_row(task_id, iteration, provider, model, prompt_tokens, input_tokens, output_tokens, latency,
+                      created_at=None):
+        return (str(task_id), iteration, provider, model, prompt_tokens, input_tokens, output_tokens, latency,
+                created_at or time.time())
+
+    def write_batch(self, tasks=(), iterations=()):
+        """Write task and iteration rows (see task_row/iteration_row) in one transaction."""
+        with self._lock:
+            connection = self._connect()
+            with connection:
+                if tasks:
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO tasks (task_id, created_at, user_input, response, stop_reason) "
+                        "VALUES (?, ?, ?, ?, ?)", tasks)
+                if iterations:
+                    connection.executemany(
+                        "INSERT OR REPLACE INTO task_iterations (task_id, iteration, provider, model, "
+                        "prompt_tokens, input_tokens, output_tokens, latency, created_at) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", iterations)
+
+    def add(self, task_id, user_input, response, created_at=None, stop_reason=None):
+        """Write a single task immediately."""
+        self.write_batch(tasks=[self.task_row(task_id, user_input, response, created_at, stop_reason)])
+
+    def get(self, task_id):
+        """Return the stored task with its iterations, or None if it doesn't exist."""
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute(
+                "SELECT task_id, created_at, user_input, response, stop_reason FROM tasks WHERE task_id = ?",
+                (str(task_id),)
+            ).fetchone()
+            iteration_rows = connection.execute(
+                "SELECT iteration, provider, model, prompt_tokens, input_tokens, output_tokens, latency "
+                "FROM task_iterations WHERE task_id = ? ORDER BY iteration", (str(task_id),)
+            ).fetchall()
+        if row is None:
+            return None
+
+        iterations = [
+            {"iteration": iteration, "provider": provider, "model": model, "prompt_tokens": prompt_tokens,
+             "input_tokens": input_tokens, "output_tokens": output_tokens, "latency": latency}
+            for iteration, provider, model, prompt_tokens, input_tokens, output_tokens, latency in iteration_rows
+        ]
+        return {"id": row[0], "created_at": row[1], "user_input": row[2], "response": json.loads(row[3]),
+                "stop_reason": row[4], "iterations": iterations}
+
+    def list(self, limit=50, before=None, since=None, until=None):
+        """Return up to `limit` tasks, newest first.
+
+        `since`/`until` bound created_at; `before` is the "<created_at>:<task_id>"
+        keyset cursor returned as next_before by the previous page, so paging stays
+        fast on large tables. Raises ValueError for a malformed cursor.
+        """
+        limit = max(1, min(limit, TASK_HISTORY_MAX_LIMIT))
+        clauses = []
+        params = []
+        if before is not None:
+            created_at, _, task_id = str(before).partition(":")
+            clauses.append("(created_at, task_id) < (?, ?)")
+            params.extend([float(created_at), task_id])
+        if since is not None:
+            clauses.append("created_at >= ?")
+            params.append(since)
+        if until is not None:
+            clauses.append("created_at <= ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(clauses)} " if clauses else ""
+
+        with self._lock:
+            rows = self._connect().execute(
+                f"SELECT task_id, created_at, stop_reason FROM tasks {where}"
+                "ORDER BY created_at DESC, task_id DESC LIMIT ?",
+                (*params, limit)
+            ).fetchall()
+
+        tasks = [{"id": task_id, "created_at": created_at, "stop_reason": stop_reason}
+                 for task_id, created_at, stop_reason in rows]
+        next_before = f"{tasks[-1]['created_at']!r}:{tasks[-1]['id']}" if len(tasks) == limit else None
+        return tasks, next_before
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+class TaskWriter:
+    """Writes tasks and iteration stats to a TaskStore from a background coroutine.
+
+    Records are queued without touching the disk and committed in one
+    transaction once `batch_size` records are waiting or `flush_interval`
+    seconds have passed since the first one. The writer runs between start()
+    and stop() (the FastAPI lifespan); records added while it isn't running on
+    the current loop are written straight away. stop() drains the queue.
+    """
+
+    def __init__(self, store, batch_size=TASK_STORE_BATCH_SIZE, flush_interval=TASK_STORE_FLUSH_INTERVAL,
+                 max_queue_size=TASK_WRITER_QUEUE_SIZE):
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.batches_written = 0
+        self.records_written = 0
+        self._queue = None
+        self._worker = None
+        self._loop = None
+
+    def running(self):
+        return (self._worker is not None and not self._worker.done()
+                and self._loop is asyncio.get_running_loop())
+
+    def start(self):
+        """Start the writer on the running event loop (no-op if already running there)."""
+        if self.running():
+            return
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self.max_queue_size)
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flush everything queued so far and stop the writer."""
+        if self._worker is None:
+            return
+        await self._queue.put(None)
+        await self._worker
+        self._worker = None
+        self._loop = None
+
+    async def add_task(self, task_id, user_input, response, stop_reason=None):
+        await self._put(("task", TaskStore.task_row(task_id, user_input, response, stop_reason=stop_reason)))
+
+    async def add_iteration(self, task_id, iteration, provider, model, prompt_tokens, input_tokens, output_tokens,
+                            latency):
+        await self._put(("iteration", TaskStore.iteration_row(
+            task_id, iteration, provider, model, prompt_tokens, input_tokens, output_tokens, latency)))
+
+    async def _put(self, record):
+        if not self.running():
+            await self._write([record])
+            return
+        # Waits only when the disk has fallen max_queue_size records behind
+        await self._queue.put(record)
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            record = await self._queue.get()
+            if record is None:
+                break
+            batch = [record]
+            deadline = self._loop.time() + self.flush_interval
+            try:
+                async with asyncio.timeout_at(deadline):
+                    while len(batch) < self.batch_size:
+                        record = await self._queue.get()
+                        if record is None:
+                            stopping = True
+                            break
+                        batch.append(record)
+            except TimeoutError:
+                pass
+            await self._write(batch)
+
+    async def _write(self, batch):
+        tasks = [row for kind, row in batch if kind == "task"]
+        iterations = [row for kind, row in batch if kind == "iteration"]
+        try:
+            await asyncio.to_thread(self.store.write_batch, tasks, iterations)
+            self.batches_written += 1
+            self.records_written += len(batch)
+        except Exception as e:
+            print(f"Error writing {len(batch)} task records: {e}")
+
+    def stats(self):
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "batches_written": self.batches_written,
+            "records_written": self.records_written,
+        }
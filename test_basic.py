@@ -5,16 +5,33 @@ Tests core functionality without requiring API keys
 """
 
 import pytest
+import asyncio
+import httpx
 import json
+import time
 import os
 import sys
-from unittest.mock import patch, MagicMock
+from unittest.mock import patch, MagicMock, AsyncMock
 from fastapi.testclient import TestClient
 
 # Add the project root to the path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+# Keep the test run from creating tasks.db in the working directory
+os.environ.setdefault("TASK_DB_PATH", ":memory:")
 
 from main import app, Mixtral
+import main
+from apis.clients import ClientRegistry
+from tag_parser import StreamingTagParser, parse_tags
+from rate_limit import RateLimiter
+from memory import ConversationMemory, MemoryStore
+from prompt_builder import PromptBuilder, prompt_budget
+from apis import tokens
+from apis.cache import ResponseCache, SQLiteCacheBackend, cached, request_key
+from jobs import JobQueue, QueueFullError
+from router import Router, ChatAdapter
+import retry
+from task_store import TaskStore, TaskWriter
 
 client = TestClient(app)
 
@@ -65,7 +82,8 @@ def test_mixtral_initialization():
     mixtral = Mixtral()
     assert mixtral is not None
     assert hasattr(mixtral, 'local_model')
-    assert hasattr(mixtral, 'wizard_queue')
+    assert hasattr(mixtral, 'wizard_concurrency')
+    assert not hasattr(mixtral, 'wizard_queue')  # wizard tasks are tracked per task
 
 
 def test_process_endpoint_structure():
@@ -82,6 +100,770 @@ def test_process_endpoint_structure():
     assert response.status_code in [200, 500, 422]
 
 
+
+@patch("main.MAX_ITERATIONS", 2)
+def test_phase_one_runs_concurrently():
+    """Test that concurrent phase_one calls overlap instead of blocking each other."""
+    mixtral = Mixtral()
+
+    async def slow_model(model_name, messages, temperature, max_tokens, on_token=None):
+        await asyncio.sleep(0.2)
+        return "<Response_to_User>done</Response_to_User>", 1, 1
+
+    mixtral.local_model.process_local_model = AsyncMock(side_effect=slow_model)
+
+    async def run_both():
+        return await asyncio.gather(
+            mixtral.phase_one("first", "a"),
+            mixtral.phase_one("second", "b"),
+        )
+
+    start = time.monotonic()
+    results = asyncio.run(run_both())
+    elapsed = time.monotonic() - start
+
+    assert all(result["response_to_user"] == "done" for result in results)
+    # Two tasks x two iterations x 0.2s would take 0.8s if run serially
+    assert elapsed < 0.7
+
+
+def test_client_registry_reuses_clients():
+    """Test that provider clients are pooled per endpoint and closed on shutdown."""
+    registry = ClientRegistry()
+    first = registry.openai_client("local", "NONE", "http://localhost:8080/v1")
+    again = registry.openai_client("local", "NONE", "http://localhost:8080/v1")
+    wizard = registry.openai_client("local", "NONE", "http://localhost:8081/v1")
+
+    assert first is again
+    assert first is not wizard
+    assert len(registry) == 2
+
+    asyncio.run(registry.aclose())
+    assert len(registry) == 0
+
+
+@patch("main.MAX_ITERATIONS", 1)
+def test_process_enqueues_and_reports_result():
+    """Test that /process returns immediately and the result can be polled."""
+    model_output = "<Response_to_User>queued answer</Response_to_User>"
+    with patch.object(main.mixtral.local_model, "process_local_model",
+                      AsyncMock(return_value=(model_output, 3, 2))):
+        with TestClient(app) as lifespan_client:
+            response = lifespan_client.post("/process", json={"user_input": "hi", "task_id": 1})
+            assert response.status_code == 200
+            task_id = response.json()["task_id"]
+
+            for _ in range(50):
+                result = lifespan_client.get(f"/tasks/{task_id}/result")
+                if result.status_code != 202:
+                    break
+                time.sleep(0.05)
+
+            assert result.status_code == 200
+            assert result.json()["response_to_user"] == "queued answer"
+
+            status = lifespan_client.get(f"/tasks/{task_id}").json()
+            assert status["status"] == "completed"
+            assert status["iteration"] == 1
+            assert status["input_tokens"] == 3
+
+
+def test_unknown_task_returns_404():
+    """Test that polling an unknown task id is a 404."""
+    assert client.get("/tasks/does-not-exist").status_code == 404
+    assert client.get("/tasks/does-not-exist/result").status_code == 404
+
+
+def test_streaming_tag_parser_handles_split_chunks():
+    """Test that sections are parsed incrementally even when tags span chunks."""
+    parser = StreamingTagParser(["Response_to_User", "questions_for_user"])
+    output = "noise <Response_to_User>Hello <b>there</b></Response_to_User> a < b <questions_for_user>Why?</questions_for_user>"
+
+    events = []
+    for i in range(0, len(output), 3):
+        events.extend(parser.feed(output[i:i + 3]))
+
+    response_text = "".join(text for kind, tag, text in events if kind == "text" and tag == "Response_to_User")
+    question_text = "".join(text for kind, tag, text in events if kind == "text" and tag == "questions_for_user")
+    assert response_text == "Hello <b>there</b>"
+    assert question_text == "Why?"
+    assert [(kind, tag) for kind, tag, _ in events if kind != "text"] == [
+        ("open", "Response_to_User"), ("close", "Response_to_User"),
+        ("open", "questions_for_user"), ("close", "questions_for_user"),
+    ]
+
+
+
+def test_parse_tags_keeps_every_occurrence():
+    """Test that repeated, missing and unterminated tags are handled in one pass."""
+    output = ("<wizard_task>one</wizard_task> text <internal_monologue>thinking</internal_monologue>"
+              "<wizard_task>two</wizard_task><Response_to_User>cut off")
+    sections = parse_tags(output)
+    assert sections["wizard_task"] == ["one", "two"]
+    assert sections["internal_monologue"] == ["thinking"]
+    assert sections["questions_for_user"] == []
+    assert sections["Response_to_User"] == ["cut off"]
+
+    response = Mixtral().format_response("no tags here")
+    assert response == {"response_to_user": "", "questions_for_user": "", "tasks": ""}
+
+@patch("main.MAX_ITERATIONS", 1)
+def test_process_stream_emits_sse_events():
+    """Test that /process/stream forwards tokens, sections and the final result."""
+    async def streaming_model(model_name, messages, temperature, max_tokens, on_token=None):
+        for chunk in ["<Response_to", "_User>Hi", " there</Response_to_User>"]:
+            await on_token(chunk)
+        return "<Response_to_User>Hi there</Response_to_User>", 1, 1
+
+    with patch.object(main.mixtral.local_model, "process_local_model", AsyncMock(side_effect=streaming_model)):
+        response = client.post("/process/stream", json={"user_input": "hi", "task_id": 1})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [json.loads(line[len("data: "):]) for line in response.text.splitlines() if line.startswith("data: ")]
+    kinds = [event["event"] for event in events]
+    assert kinds[0] == "task"
+    assert "token" in kinds
+    assert "".join(e["text"] for e in events if e["event"] == "section_text") == "Hi there"
+    assert events[-1]["event"] == "result"
+    assert events[-1]["response_to_user"] == "Hi there"
+
+    # Streamed tasks go through the bounded job queue, so they are tracked and rejected when it is full
+    task_id = events[0]["task_id"]
+    assert main.job_queue.get(task_id)["status"] == "completed"
+    with patch.object(main.job_queue, "submit", side_effect=QueueFullError("Job queue is full")):
+        assert client.post("/process/stream", json={"user_input": "hi", "task_id": 1}).status_code == 503
+
+
+def test_job_queue_cancels_queued_and_running_jobs():
+    """Test that cancelling a job stops it without stopping the worker that ran it."""
+    started = []
+
+    async def handler(task_id, user_input, job):
+        started.append(task_id)
+        if user_input == "hang":
+            await asyncio.sleep(5)
+        return {"response_to_user": user_input}
+
+    async def scenario():
+        queue = JobQueue(handler, workers=1, max_queue_size=10)
+        queue.start()
+        hanging = queue.submit("hanging", "hang")
+        queued = queue.submit("queued", "never runs")
+        after = queue.submit("after", "done")
+        queue.cancel("queued")
+        await asyncio.sleep(0.05)
+        queue.cancel("hanging")
+        await asyncio.sleep(0.05)
+        await queue.stop()
+        return hanging, queued, after
+
+    hanging, queued, after = asyncio.run(scenario())
+    assert (hanging["status"], hanging["error"]) == ("failed", "cancelled")
+    assert (queued["status"], queued["error"]) == ("failed", "cancelled")
+    assert after["status"] == "completed"
+    assert started == ["hanging", "after"]
+
+
+def test_wizard_tasks_dispatched_concurrently_in_order():
+    """Test that wizard tasks run in parallel, keep input order and respect the timeout."""
+    mixtral = Mixtral()
+    mixtral.wizard_timeout = 0.5
+    delays = {"slow": 0.2, "fast": 0.0, "hang": 5}
+
+    async def wizard_model(model_name, messages, temperature, max_tokens, on_token=None):
+        task = messages[-1]["content"]
+        await asyncio.sleep(delays[task])
+        return f"answer to {task}", 1, 1
+
+    mixtral.local_model.process_local_model = AsyncMock(side_effect=wizard_model)
+
+    limiter = RateLimiter({}, requests_per_minute=1000, tokens_per_minute=10**6)
+    start = time.monotonic()
+    with patch("main.rate_limiter", limiter):
+        results = asyncio.run(mixtral.dispatch_wizard_tasks(["slow", "fast", "hang"]))
+    elapsed = time.monotonic() - start
+
+    assert results == [("answer to slow", None), ("answer to fast", None), (None, "timed out")]
+    assert elapsed < 1.5
+    # Only the two answered calls stay charged; the timed-out reservation is refunded
+    assert limiter.stats()["local/WizardCoder-17b"]["tokens"] == 4
+
+
+def test_rate_limiter_isolates_keys_and_reconciles():
+    """Test per-model buckets: one exhausted model doesn't throttle another, and usage is reconciled."""
+    config = {"LOCAL_MODELS": {"mixtral-8x7b-local": {"tokens_per_minute": 6000}}}
+    limiter = RateLimiter(config, requests_per_minute=15, tokens_per_minute=450000)
+
+    async def scenario():
+        first = await limiter.acquire("local", "mixtral-8x7b-local", 6000)
+        limiter.reconcile(first, 5990)
+        # The local token bucket is nearly empty; a different provider is unaffected
+        other = await limiter.acquire("openai", "gpt-3.5-turbo-0125", 100)
+        second = await limiter.acquire("local", "mixtral-8x7b-local", 20)
+        return other, second
+
+    other, second = asyncio.run(scenario())
+
+    assert other.wait_time < 0.05
+    assert 0.05 < second.wait_time < 0.5
+    stats = limiter.stats()
+    assert stats["local/mixtral-8x7b-local"]["requests"] == 2
+    assert stats["local/mixtral-8x7b-local"]["tokens"] == 6010
+    assert stats["local/mixtral-8x7b-local"]["waits"] == 1
+
+
+def test_rate_limiter_shares_provider_limits():
+    """Test that models of a provider listed under PROVIDER_LIMITS draw from one shared bucket."""
+    config = {"PROVIDER_LIMITS": {"perplexity": {"tokens_per_minute": 6000}}}
+    limiter = RateLimiter(config, requests_per_minute=100, tokens_per_minute=450000)
+
+    async def scenario():
+        first = await limiter.acquire("perplexity", "mistral-7b-instruct", 6000)
+        limiter.reconcile(first, 5990)
+        # Another model has its own model bucket, but the provider's quota is nearly used up
+        return await limiter.acquire("perplexity", "mixtral-8x7b-instruct", 20)
+
+    assert 0.05 < asyncio.run(scenario()).wait_time < 0.5
+    assert limiter.headroom("local", "mixtral-8x7b-local") == 1.0
+    assert limiter.headroom("perplexity", "codellama-70b-instruct") < 0.01
+
+
+def test_conversation_memory_is_bounded_and_isolated():
+    """Test that memory stays within its caps and sessions don't share entries."""
+    memory = ConversationMemory(short_size=5, long_size=50, long_tokens=100)
+    for i in range(1000):
+        memory.add(f"thought {i:04d} " + "x" * 20)
+
+    assert list(memory.short)[-1].startswith("thought 0999")
+    assert len(memory.short) == 5
+    assert len(memory.long) <= 50
+    assert memory.long_token_count <= 100
+    long_sample, short_sample = memory.sample(k=3)
+    assert 1 <= len(long_sample) <= 3
+    assert set(short_sample) <= set(memory.short)
+
+    store = MemoryStore(max_sessions=2)
+    store.get("a").add("only in a")
+    assert len(store.get("b").long) == 0
+    store.get("c")
+    assert len(store) == 2
+
+
+def test_prompt_builder_respects_budget_and_dedupes():
+    """Test that the system prompt keeps its base, drops duplicates and stays within budget."""
+    builder = PromptBuilder("BASE PROMPT", count_tokens=lambda text: len(text.split()))
+    prompt, report = builder.build([
+        ("monologue", ["think about scraping"]),
+        ("short_memory", ["Think about  scraping", "pick a parser"]),
+        ("long_memory", ["an old and very long thought that will not fit"]),
+    ], budget=12)
+
+    assert prompt == "BASE PROMPT think about scraping pick a parser"
+    assert report["base"] == 2
+    assert report["monologue"] == 4
+    assert report["short_memory"] == 4
+    assert report["long_memory"] == 0
+    assert report["dropped"] == 1
+    assert report["total"] <= 12
+
+    config = {"LOCAL_MODELS": {"mixtral-8x7b-local": {"context_window": 1000}}}
+    assert prompt_budget(config, "local", "mixtral-8x7b-local", 100, 300) == 600
+    assert prompt_budget(config, "local", "unknown", 100, 300) is None
+
+
+@patch("main.MAX_ITERATIONS", 30)
+@patch("main.DELAY_DURATION", 0)
+@patch("main.rate_limiter", RateLimiter({}, requests_per_minute=100000, tokens_per_minute=10**9))
+def test_system_prompt_does_not_grow_with_iterations():
+    """Test that the rebuilt system prompt stays bounded over many iterations."""
+    mixtral = Mixtral()
+    # Run every iteration; the outputs below would otherwise count as converged
+    mixtral.stop_conditions = []
+    prompt_sizes = []
+
+    async def model(model_name, messages, temperature, max_tokens, on_token=None):
+        prompt_sizes.append(len(messages[0]["content"]))
+        thought = f"<internal_monologue>step {len(prompt_sizes)} notes</internal_monologue>"
+        return thought, 1, 1
+
+    mixtral.local_model.process_local_model = AsyncMock(side_effect=model)
+    asyncio.run(mixtral.phase_one("hello", "prompt-growth"))
+
+    assert len(prompt_sizes) == 30
+    assert max(prompt_sizes[10:]) <= max(prompt_sizes[:10]) + 50
+
+
+def test_token_counting_prefers_reported_usage():
+    """Test the pluggable tokenizer registry and the usage fallback order."""
+    tokens.register_tokenizer("words", lambda name: lambda text: len(text.split()))
+    messages = [{"role": "system", "content": "be brief"}, {"role": "user", "content": "say hi"}]
+
+    assert tokens.count_tokens("words:any", "one two three") == 3
+    assert tokens.count_message_tokens("words:any", messages) == 4 + 2 * tokens.MESSAGE_OVERHEAD_TOKENS
+    assert tokens.resolve_usage("words:any", messages, "hi there", 50, 7) == (50, 7)
+    assert tokens.resolve_usage("words:any", messages, "hi there", None, None) == (12, 2)
+    # Unknown families fall back to the character estimate
+    assert tokens.count_tokens("missing:tokenizer", "x" * 40) == 10
+
+
+
+def test_prefetch_tokenizers_reports_failures(tmp_path):
+    """Test that prefetching loads every configured tokenizer and reports the ones it couldn't get."""
+    tokens.register_tokenizer("words", lambda name: lambda text: len(text.split()))
+    config_path = tmp_path / "config.json"
+    config_path.write_text(json.dumps({
+        "LOCAL_MODELS": {"a": {"tokenizer": "words:any"}, "b": {"tokenizer": "missing:tokenizer"}, "c": {}},
+        "PROVIDER_LIMITS": {"local": {"requests_per_minute": 10}},
+    }))
+    assert tokens.prefetch_tokenizers(str(config_path)) == ["missing:tokenizer"]
+
+
+def test_response_cache_hits_misses_and_bypass(tmp_path):
+    """Test that identical deterministic calls are served from cache, and sampled ones bypass it."""
+    cache = ResponseCache(max_size=2, ttl=60, path=str(tmp_path / "cache.sqlite"))
+
+    class FakeAdapter:
+        calls = 0
+
+        @cached("fake", cache=cache)
+        async def process_fake_model(self, model_name, messages, temperature, max_tokens, on_token=None):
+            FakeAdapter.calls += 1
+            return f"reply {FakeAdapter.calls}", 5, 2
+
+    adapter = FakeAdapter()
+    messages = [{"role": "user", "content": "same question"}]
+    streamed = []
+
+    async def on_token(text):
+        streamed.append(text)
+
+    async def scenario():
+        first = await adapter.process_fake_model("m", messages, 0, 100)
+        second = await adapter.process_fake_model("m", messages, 0, 100, on_token=on_token)
+        sampled = await adapter.process_fake_model("m", messages, 0.5, 100)
+        return first, second, sampled
+
+    first, second, sampled = asyncio.run(scenario())
+
+    assert first == second == ("reply 1", 5, 2)
+    assert streamed == ["reply 1"]
+    assert sampled == ("reply 2", 5, 2)
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+    assert cache.stats()["bypassed"] == 1
+
+    # The SQLite backend survives a fresh in-memory cache
+    reopened = ResponseCache(path=str(tmp_path / "cache.sqlite"))
+    cache.close()
+    key = request_key("fake", {"model_name": "m", "messages": messages, "temperature": 0, "max_tokens": 100})
+    key_hit = asyncio.run(reopened.get(key))
+    assert key_hit == ["reply 1", 5, 2]
+    reopened.close()
+
+    # Expired rows are deleted from disk, not just ignored
+    backend = SQLiteCacheBackend(str(tmp_path / "cache.sqlite"))
+    backend.set("stale", ["old", 1, 1], time.time() - 1)
+    assert backend.get("stale") is None
+    backend.set("stale-2", ["old", 1, 1], time.time() - 1)
+    assert backend.purge() >= 1
+    assert backend._connection.execute("SELECT COUNT(*) FROM response_cache WHERE expires_at < ?",
+                                       (time.time(),)).fetchone()[0] == 0
+    backend.close()
+
+
+def test_router_cache_hits_skip_rate_limiter():
+    """Test that identical routed calls answered from the cache don't use rate-limit capacity."""
+    cache = ResponseCache(max_size=10, ttl=60, path="")
+    provider_calls = []
+
+    class CachedModel:
+        @cached("local", cache=cache)
+        async def process_local_model(self, model_name, messages, temperature, max_tokens, on_token=None):
+            provider_calls.append(model_name)
+            return "cached reply", 100, 100
+
+    limiter = RateLimiter({}, requests_per_minute=1000, tokens_per_minute=10**6)
+    router = Router({"LOCAL_MODELS": {"m": {"cost": "$"}}}, limiter,
+                    {"local": ChatAdapter(CachedModel(), "process_local_model")}, [("local", "m")])
+    messages = [{"role": "user", "content": "same"}]
+
+    async def scenario():
+        return [await router.complete(messages, 0, 100) for _ in range(5)]
+
+    results = asyncio.run(scenario())
+    assert all(result[0] == "cached reply" for result in results)
+    assert len(provider_calls) == 1
+    assert limiter.stats()["local/m"]["requests"] == 1
+    assert limiter.stats()["local/m"]["tokens"] == 200
+    assert (cache.stats()["hits"], cache.stats()["misses"]) == (4, 1)
+
+
+def test_task_store_pagination_and_fetch():
+    """Test batch writes, newest-first keyset pagination, time filters and fetch-by-id."""
+    store = TaskStore(":memory:")
+    store.write_batch(tasks=[
+        TaskStore.task_row(f"task-{i}", f"input {i}", {"response_to_user": f"answer {i}"}, created_at=1000.0 + i)
+        for i in range(10)
+    ])
+
+    page, next_before = store.list(limit=4)
+    assert [task["id"] for task in page] == ["task-9", "task-8", "task-7", "task-6"]
+    page, next_before = store.list(limit=4, before=next_before)
+    assert [task["id"] for task in page] == ["task-5", "task-4", "task-3", "task-2"]
+    page, next_before = store.list(limit=4, before=next_before)
+    assert [task["id"] for task in page] == ["task-1", "task-0"]
+    assert next_before is None
+
+    page, _ = store.list(since=1003.0, until=1005.0)
+    assert [task["id"] for task in page] == ["task-5", "task-4", "task-3"]
+
+    # Rows sharing a timestamp across a page boundary are neither skipped nor repeated
+    store.write_batch(tasks=[TaskStore.task_row(f"tie-{i}", "", {}, created_at=2000.0 + i // 3) for i in range(6)])
+    seen, before = [], None
+    while True:
+        page, before = store.list(limit=4, before=before, since=2000.0)
+        seen.extend(task["id"] for task in page)
+        if before is None:
+            break
+    assert sorted(seen) == [f"tie-{i}" for i in range(6)]
+    assert len(seen) == 6
+
+    task = store.get("task-7")
+    assert task["user_input"] == "input 7"
+    assert task["response"] == {"response_to_user": "answer 7"}
+    assert store.get("missing") is None
+    store.close()
+
+
+def test_task_history_record_endpoint():
+    """Test fetching a stored task by id over HTTP."""
+    main.task_store.add("history-test", "stored input", {"response_to_user": "stored answer"})
+    response = client.get("/task-history/history-test")
+    assert response.status_code == 200
+    assert response.json()["user_input"] == "stored input"
+    assert client.get("/task-history/unknown-task").status_code == 404
+    assert client.get("/task-history", params={"before": "not-a-cursor"}).status_code == 400
+
+
+def test_task_writer_batches_and_drains_on_stop():
+    """Test that the background writer batches records and flushes everything on stop."""
+    store = TaskStore(":memory:")
+    writer = TaskWriter(store, batch_size=10, flush_interval=60)
+
+    async def scenario():
+        writer.start()
+        for i in range(3):
+            await writer.add_iteration("bg-task", i + 1, "local", "mixtral-8x7b-local", 300, 310, 20, 0.5)
+        await writer.add_task("bg-task", "input", {"response_to_user": "done"})
+        # Nothing reaches the disk until the batch fills, the interval passes or the writer stops
+        await asyncio.sleep(0.05)
+        assert store.get("bg-task") is None
+        await writer.stop()
+
+    asyncio.run(scenario())
+
+    task = store.get("bg-task")
+    assert task["response"] == {"response_to_user": "done"}
+    assert [iteration["iteration"] for iteration in task["iterations"]] == [1, 2, 3]
+    assert task["iterations"][0]["prompt_tokens"] == 300
+    assert writer.stats()["batches_written"] == 1
+    assert writer.stats()["records_written"] == 4
+
+    # Without a running writer (e.g. outside the app lifespan) records are written immediately
+    asyncio.run(writer.add_task("direct-task", "input", {"response_to_user": "now"}))
+    assert store.get("direct-task")["response"] == {"response_to_user": "now"}
+
+def test_router_prefers_cheap_models_and_fails_over():
+    """Test that the router ranks by cost and health and fails over on errors."""
+    config = {
+        "LOCAL_MODELS": {"cheap": {"cost": "$", "context_window": 1000}},
+        "OPENAI_MODELS": {"paid": {"cost": "$$$", "context_window": 1000}},
+    }
+    calls = []
+
+    class FakeAdapter:
+        def __init__(self, fail=False):
+            self.fail = fail
+
+        async def complete(self, model_key, messages, temperature, max_tokens, on_token=None):
+            calls.append(model_key)
+            if self.fail:
+                raise RuntimeError("provider down")
+            return f"from {model_key}", 1, 1
+
+    limiter = RateLimiter({}, requests_per_minute=1000, tokens_per_minute=10**6)
+    router = Router(config, limiter, {"local": FakeAdapter(fail=True), "openai": FakeAdapter()},
+                    [("openai", "paid"), ("local", "cheap"), ("claude", "unconfigured")])
+    messages = [{"role": "user", "content": "hi"}]
+
+    assert router.models == [("openai", "paid"), ("local", "cheap")]
+    assert router.candidates(messages, 10) == [("local", "cheap"), ("openai", "paid")]
+
+    result = asyncio.run(router.complete(messages, 0, 10))
+    assert result == ("from paid", 1, 1, ("openai", "paid"))
+    assert calls == ["cheap", "paid"]
+
+    # The error rate outweighs the cost difference, and repeated failures start a cooldown
+    assert router.candidates(messages, 10)[0] == ("openai", "paid")
+    for _ in range(3):
+        router.record("local", "cheap", 0.1, False)
+    assert router.stats()["models"]["local/cheap"]["cooling_down"]
+    # Requests that don't fit a model's context window go elsewhere first
+    assert router.candidates(messages, 5000)[-1] == ("local", "cheap")
+
+
+def test_call_with_retries_retries_only_retryable_errors():
+    """Test deadlines, jittered retries and the retryable/non-retryable split."""
+    class StatusError(Exception):
+        def __init__(self, status_code):
+            super().__init__(f"HTTP {status_code}")
+            self.status_code = status_code
+
+    assert retry.is_retryable(httpx.ConnectError("refused"))
+    assert retry.is_retryable(asyncio.TimeoutError())
+    assert retry.is_retryable(StatusError(503))
+    assert not retry.is_retryable(StatusError(400))
+    assert not retry.is_retryable(ValueError("bad request"))
+    assert all(0 <= retry.backoff_delay(attempt, 0.5, 2) <= min(2, 0.5 * 2 ** attempt) for attempt in range(6))
+
+    def flaky(errors):
+        attempts = []
+
+        async def call():
+            attempts.append(True)
+            if len(attempts) <= len(errors):
+                raise errors[len(attempts) - 1]
+            return "ok"
+        return call, attempts
+
+    with patch("retry.backoff_delay", return_value=0):
+        call, attempts = flaky([httpx.ConnectError("refused"), StatusError(429)])
+        assert asyncio.run(retry.call_with_retries(call, timeout=1, max_retries=2)) == "ok"
+        assert len(attempts) == 3
+
+        call, attempts = flaky([StatusError(400)])
+        with pytest.raises(StatusError):
+            asyncio.run(retry.call_with_retries(call, timeout=1, max_retries=2))
+        assert len(attempts) == 1
+
+        async def hang():
+            await asyncio.sleep(5)
+
+        start = time.monotonic()
+        with pytest.raises(TimeoutError):
+            asyncio.run(retry.call_with_retries(hang, timeout=0.05, max_retries=1))
+        assert time.monotonic() - start < 1
+
+
+def test_router_hedges_slow_calls():
+    """Test that a slow call is hedged to the next candidate and the loser is cancelled and reconciled."""
+    config = {"LOCAL_MODELS": {"replica-a": {"cost": "$"}, "replica-b": {"cost": "$"}}}
+    delays = {"replica-a": 5, "replica-b": 0.01}
+    failing = set()
+    calls = []
+
+    class ReplicaAdapter:
+        async def complete(self, model_key, messages, temperature, max_tokens, on_token=None):
+            calls.append(model_key)
+            await asyncio.sleep(delays[model_key])
+            if model_key in failing:
+                raise RuntimeError(f"{model_key} down")
+            return f"from {model_key}", 1, 1
+
+    limiter = RateLimiter({}, requests_per_minute=1000, tokens_per_minute=10**6)
+    router = Router(config, limiter, {"local": ReplicaAdapter()},
+                    [("local", "replica-a"), ("local", "replica-b")], hedge=True, hedge_min_delay=0.05)
+    messages = [{"role": "user", "content": "hi"}]
+
+    start = time.monotonic()
+    content, _, _, route = asyncio.run(router.complete(messages, 0, 10))
+    assert (content, route) == ("from replica-b", ("local", "replica-b"))
+    assert time.monotonic() - start < 1
+    stats = router.stats()
+    assert (stats["hedges_sent"], stats["hedges_won"]) == (1, 1)
+    assert stats["models"]["local/replica-a"]["cancelled"] == 1
+    assert stats["models"]["local/replica-a"]["error_rate"] == 0
+    # The cancelled attempt keeps only its prompt charged
+    assert limiter.stats()["local/replica-a"]["tokens"] < 10
+
+    # When both hedged calls fail the backup isn't called a second time
+    delays["replica-a"] = 0.2
+    failing.update(["replica-a", "replica-b"])
+    calls.clear()
+    with pytest.raises(RuntimeError):
+        asyncio.run(router.complete(messages, 0, 10))
+    assert sorted(calls) == ["replica-a", "replica-b"]
+
+def test_monster_polls_jobs_concurrently():
+    """Test that Monster jobs are polled asynchronously until they complete or fail."""
+    from apis import monster
+    polls = {}
+
+    def handler(request):
+        if request.method == "POST":
+            prompt = json.loads(request.content)["prompt"]
+            return httpx.Response(200, json={"process_id": prompt})
+        process_id = request.url.path.rsplit("/", 1)[-1]
+        polls[process_id] = polls.get(process_id, 0) + 1
+        if polls[process_id] < 3:
+            return httpx.Response(200, json={"status": "IN_PROGRESS"})
+        if process_id.startswith("bad"):
+            return httpx.Response(200, json={"status": "FAILED", "result": "oom"})
+        return httpx.Response(200, json={"status": "COMPLETED", "result": {"text": [process_id, "!"]}})
+
+    async def run():
+        http = httpx.AsyncClient(base_url=monster.MONSTER_BASE_URL, transport=httpx.MockTransport(handler))
+        api = monster.MonsterAPI()
+        with patch.object(monster.clients, "http_client", return_value=http), \
+                patch.object(monster, "MONSTER_POLL_INITIAL", 0.01), patch.object(monster, "MONSTER_POLL_MAX", 0.02):
+            start = time.monotonic()
+            results = await asyncio.gather(*(
+                api.process_monster_model("mpt-7b-instruct", [{"role": "user", "content": f"job-{i}-{time.time()}"}], 0, 10)
+                for i in range(20)))
+            elapsed = time.monotonic() - start
+            with pytest.raises(monster.MonsterJobError):
+                await api.process_monster_model("mpt-7b-instruct", [{"role": "user", "content": f"bad-{time.time()}"}], 0, 10)
+        await http.aclose()
+        return results, elapsed
+
+    results, elapsed = asyncio.run(run())
+    assert all(content.endswith("!") and content.startswith("job-") for content, _, _ in results)
+    assert all(count == 3 for count in polls.values())
+    # 20 jobs polled together take about as long as one
+    assert elapsed < 1
+
+
+def test_process_batch_streams_results_as_they_complete():
+    """Test that /process/batch accepts JSON or JSONL and streams results in completion order."""
+    running = []
+    peak = []
+
+    async def handler(task_id, user_input, job, session_id=None):
+        running.append(task_id)
+        peak.append(len(running))
+        try:
+            await asyncio.sleep(float(user_input.split()[-1]))
+            if user_input.startswith("fail"):
+                raise RuntimeError("model down")
+            return {"response_to_user": user_input}
+        finally:
+            running.remove(task_id)
+
+    items = [{"user_input": "slow 0.2", "task_id": 1}, {"user_input": "fast 0", "task_id": 2},
+             {"user_input": "fail 0", "task_id": 3}]
+    with patch.object(main.job_queue, "handler", handler), patch("main.BATCH_CONCURRENCY", 2):
+        response = client.post("/process/batch", json=items)
+        jsonl = "\n".join(json.dumps({"request_id": f"r-{i}", "title": "t", "body": f"fast {i / 100}"})
+                          for i in range(5))
+        jsonl_response = client.post("/process/batch", content=jsonl,
+                                     headers={"Content-Type": "application/x-ndjson"})
+
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["task_id"] for line in lines[:-1]] == [2, 3, 1]
+    assert lines[1]["error"] == "model down"
+    assert lines[2]["result"] == {"response_to_user": "slow 0.2"}
+    assert lines[-1] == {"done": True, "completed": 2, "failed": 1}
+    assert max(peak) <= 2
+
+    jsonl_lines = [json.loads(line) for line in jsonl_response.text.splitlines()]
+    assert sorted(line["task_id"] for line in jsonl_lines[:-1]) == [f"r-{i}" for i in range(5)]
+    assert jsonl_lines[-1]["completed"] == 5
+
+    assert client.post("/process/batch", content="{not json\n").status_code == 400
+    assert client.post("/process/batch", json=[{"task_id": 1}]).status_code == 400
+
+
+def test_shared_state_is_seen_by_every_worker():
+    """Test that rate limits, session memory, job status and the cache are shared through the state store."""
+    fakeredis = pytest.importorskip("fakeredis")
+    from state import RedisState
+    from memory import MemoryStore
+
+    async def handler(task_id, user_input, job):
+        return {"response_to_user": user_input}
+
+    async def scenario():
+        server = fakeredis.FakeServer()
+        workers = [RedisState(client=fakeredis.aioredis.FakeRedis(server=server)) for _ in range(2)]
+        config = {"LOCAL_MODELS": {"m": {"requests_per_minute": 2}}}
+        limiters = [RateLimiter(config, 100, 10**6, state=state) for state in workers]
+
+        # Two requests per minute in total, not per worker
+        await limiters[0].acquire("local", "m", 1)
+        await limiters[1].acquire("local", "m", 1)
+        with pytest.raises(TimeoutError):
+            async with asyncio.timeout(0.2):
+                await limiters[0].acquire("local", "m", 1)
+
+        stores = [MemoryStore(state=state) for state in workers]
+        memory = await stores[0].load("session")
+        memory.add("remember this")
+        await stores[0].save("session", memory)
+        assert list((await stores[1].load("session")).short) == ["remember this"]
+
+        queue = JobQueue(handler, workers=1, state=workers[0])
+        other_queue = JobQueue(handler, workers=1, state=workers[1])
+        queue.submit("job-1", "hello")
+        await asyncio.sleep(0.05)
+        await queue.stop()
+        await workers[0].aclose()
+        assert (await other_queue.lookup("job-1"))["result"] == {"response_to_user": "hello"}
+
+        caches = [ResponseCache(state=state) for state in workers]
+        await caches[1].set("key", ["cached", 1, 1])
+        return await caches[0].get("key")
+
+    assert asyncio.run(scenario()) == ["cached", 1, 1]
+
+
+@patch("main.MAX_ITERATIONS", 50)
+def test_phase_one_stops_early_and_records_the_reason():
+    """Test the final-answer, convergence, budget and deadline stop conditions."""
+    import stop
+
+    def run(conditions, outputs, delay=0):
+        mixtral = Mixtral()
+        mixtral.stop_conditions = conditions
+        calls = []
+
+        async def model(model_name, messages, temperature, max_tokens, on_token=None):
+            calls.append(True)
+            await asyncio.sleep(delay)
+            return outputs(len(calls)), 10, 10
+
+        mixtral.local_model.process_local_model = AsyncMock(side_effect=model)
+        response = asyncio.run(mixtral.phase_one("hello", f"stop-{time.time()}"))
+        return response, len(calls)
+
+    final = lambda n: f"<Response_to_User>{'v' * n}{n * 7919}</Response_to_User>" + \
+        ("<final_answer></final_answer>" if n == 3 else "")
+    response, calls = run(stop.default_stop_conditions(), final)
+    assert (response["stop_reason"], response["iterations"], calls) == ("final_answer", 3, 3)
+    assert response["response_to_user"] == "vvv23757"
+
+    same = lambda n: "<Response_to_User>" + ("draft" if n == 1 else "the same long answer every time") + "</Response_to_User>"
+    response, calls = run([stop.Converged(0.95)], same)
+    assert (response["stop_reason"], calls) == ("converged", 3)
+
+    changing = lambda n: f"<Response_to_User>{'x' * n}{n * 7919}</Response_to_User>"
+    response, calls = run([stop.Converged(0.95), stop.TokenBudget(60)], changing)
+    assert (response["stop_reason"], calls) == ("token_budget", 3)
+
+    response, calls = run([stop.Deadline(0.25)], changing, delay=0.1)
+    assert response["stop_reason"] == "deadline"
+    assert response["iterations"] == 2 and calls == 3
+
+    response, calls = run([], changing)
+    assert (response["stop_reason"], calls) == ("max_iterations", 50)
+
+    store = TaskStore(":memory:")
+    store.add("t", "hi", response, stop_reason=response["stop_reason"])
+    assert store.get("t")["stop_reason"] == "max_iterations"
+    assert store.list()[0][0]["stop_reason"] == "max_iterations"
+
+
 if __name__ == "__main__":
     # Run basic tests
     print("Running basic validation tests...")
@@ -98,4 +880,4 @@ if __name__ == "__main__":
     print("✓ Testing Mixtral initialization...")
     test_mixtral_initialization()
     
-    print("\n✅ All basic tests passed!")
\ No newline at end of file
+    print("\n✅ All basic tests passed!")